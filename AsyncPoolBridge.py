@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#-*- encoding:utf-8 -*-
+"""
+AsyncPoolBridge runs blocking calls of asyncio code in a DynamicThreadPool,
+a replacement of loop.run_in_executor() with a pool that sheds idle threads.
+e.g.
+    pool = DynamicThreadPool(8, 10)
+    bridge = AsyncPoolBridge(pool)
+
+    async def handler():
+        data = await bridge.submit(read_file, path)
+
+submit() returns an asyncio future of the event loop, resolved on the loop.
+Completions are handed over in batches: workers only append to a deque and the
+first of a batch schedules one call_soon_threadsafe(), so 10k tasks finishing
+together wake the loop a few times instead of 10k times.
+
+Cancelling the asyncio future cancels the task if it is still waiting in the
+pool queue, a running task runs to its end and its result is dropped.
+
+Python 3.5+ only, one bridge per event loop.
+"""
+import asyncio
+import functools
+
+from collections import deque
+
+from DynamicThreadPool import DynamicThreadPool
+
+
+class AsyncPoolBridge(object):
+    def __init__(self, pool, loop=None):
+        self.pool = pool
+        self.loop = loop
+        self.completed = deque()
+        self.flush_scheduled = False
+        #loop wakeups, for the curious
+        self.n_flushes = 0
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Post func(*args, **kwargs) to the pool, return an awaitable asyncio future.
+        A bounded pool raises Full instead of blocking the event loop.
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        waiter = self.loop.create_future()
+        future = self.pool.submit(func, args, kwargs, block=False)
+        waiter.add_done_callback(functools.partial(self._on_waiter_done, future))
+        future.add_done_callback(functools.partial(self._on_done, waiter))
+        return waiter
+
+    def map(self, func, iterable):
+        """Return an awaitable of the list of func(item), run in the pool"""
+        return asyncio.gather(*[self.submit(func, item) for item in iterable])
+
+    def _on_done(self, waiter, future):
+        #called by the worker thread
+        self.completed.append((waiter, future))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        #cleared before draining: a completion appended after the drain
+        #started sees False and schedules the next flush
+        self.flush_scheduled = False
+        self.n_flushes += 1
+        completed = self.completed
+        while completed:
+            waiter, future = completed.popleft()
+            if waiter.done():
+                continue
+            exception = future.exception()
+            if exception is None:
+                waiter.set_result(future.result())
+            else:
+                waiter.set_exception(exception)
+
+    def _on_waiter_done(self, future, waiter):
+        if waiter.cancelled():
+            self.pool.cancel(future)
+
+
+if __name__ == "__main__":
+    import time
+    import threading
+
+    def square(i):
+        if i < 0:
+            raise ValueError(i)
+        return i * i
+
+    async def main(bridge):
+        assert await bridge.submit(square, 3) == 9
+        try:
+            await bridge.submit(square, -1)
+        except ValueError:
+            pass
+        else:
+            assert False, "ValueError expected"
+
+        assert await bridge.map(square, range(10000)) == [i * i for i in range(10000)]
+        assert bridge.n_flushes < 1000, bridge.n_flushes
+
+        #the loop keeps running while the pool blocks
+        gate = threading.Event()
+        blocked = bridge.submit(gate.wait)
+        queued = bridge.submit(square, 4)
+        await asyncio.sleep(0.05)
+        queued.cancel()
+        await asyncio.sleep(0.05)
+        assert bridge.pool.snapshot()['n_pending_tasks'] == 0
+        gate.set()
+        assert await blocked is True
+
+        try:
+            await asyncio.wait_for(bridge.submit(time.sleep, 0.5), 0.05)
+        except asyncio.TimeoutError:
+            pass
+
+    pool = DynamicThreadPool(1, 1)
+    bridge = AsyncPoolBridge(pool)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main(bridge))
+    loop.close()
+    pool.terminate()
+    print('flushes for 10k tasks: {0}'.format(bridge.n_flushes))
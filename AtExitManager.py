@@ -8,61 +8,99 @@ thread.lock
 ͬһᵼ״̬ͷһס״̬lockᵼerror
 
 AtExitManager  atexitģ飬ֶ̡֧߳ StackûԪص
+
+Like atexit, the tasks registered last run first, within their priority.
+Registering returns a handle, unregister(handle) removes the task in O(1),
+e.g. a per-connection cleanup once the connection closes normally. The stack
+is swapped out before being processed, so registering never waits for the
+processing, a task registered meanwhile waits for the next one.
+
+processTasks() runs the tasks by ascending priority, the tasks of one priority
+in parallel on up to `max_workers` threads, so a slow callback does not hold
+the others back:
+    manager.registerCallback(flush_logs, priority=0, timeout=2)
+    manager.registerCallback(close_db, db, priority=1)
+    report = manager.processTasks(timeout=10)
+
+A task running longer than its own `timeout` is left behind and reported as
+overran, its thread is replaced. Past the global `timeout` of processTasks(),
+the running tasks are reported as overran and the rest as skipped. The threads
+are daemonic, the tasks left behind do not hold the exit.
+
+install() hooks the manager to atexit and SIGTERM, the global_manager does it
+on the first registration. On SIGTERM, the tasks are processed then the
+previous handler runs, the default one terminates the process by the signal.
+The handler itself only hands the processing over to a thread and returns:
+the frame it interrupted may hold the lock of the stack.
 '''
 
+import os
+import atexit
+import signal
+import logging
+import itertools
 import threading
 
+from collections import deque, OrderedDict
 
-#ScopedLockûʲôãthread.lock֧with䡣
-class ScopedLock(object):
-    def __init__(self, mutex):
-        self._mutex = mutex;
-
-    def __enter__(self):
-        self._mutex.acquire()
+from timetools import monotonic, Deadline
+from locktools import guard
 
-    def __exit__(self, type, value, traceback):
-        if self._mutex.locked():
-            self._mutex.release()
-            return True
 
-    def __del__(self):
-        if self._mutex.locked():
-            self._mutex.release()
-        
+#ScopedLockûʲôãthread.lock֧with䣬guard()صľlock
+ScopedLock = guard
 
 
 class Stack(object):
+    """A LIFO of items pushed under a handle, to remove them in O(1)"""
     def __init__(self, mutex, initlist=None):
-        self._list = []
+        #handle -> item, in push order
+        self._items = OrderedDict()
+        self._handles = itertools.count()
         self._mutex = mutex
         if initlist is not None:
-            self._list.extend(initlist)
+            for item in initlist:
+                self.push(item)
     
     def __iter__(self):
-        with ScopedLock(self._mutex):
-            while self._list:
-                yield self._list.pop()
+        #drains a snapshot, items pushed meanwhile are left for the next drain
+        with guard(self._mutex):
+            items, self._items = self._items, OrderedDict()
+        while items:
+            yield items.popitem()[1]
 
     def __len__(self):
-        return len(self._list)
+        return len(self._items)
 
     def push(self, item):
-        with ScopedLock(self._mutex):
-            self._list.insert(0, item)
-        return len(self._list)
+        """Push the item, return its handle"""
+        with guard(self._mutex):
+            handle = next(self._handles)
+            self._items[handle] = item
+        return handle
+
+    def remove(self, handle):
+        """Remove the item pushed under `handle`, return False if it is gone already"""
+        with guard(self._mutex):
+            return self._items.pop(handle, None) is not None
 
     def pop(self):
-        with ScopedLock(self._mutex):
-            return self._list.pop()
+        with guard(self._mutex):
+            if not self._items:
+                raise IndexError("pop from empty stack")
+            return self._items.popitem()[1]
 
     def size(self):
-        with ScopedLock(self._mutex):
-            return len(self._list)
+        with guard(self._mutex):
+            return len(self._items)
         
 
 
 class Task(object):
+    #run before the tasks of higher priorities, None for no timeout
+    priority = 0
+    timeout = None
+
     def __init__(self, func, *args):
         self._func = func or None
         self._args = args
@@ -70,12 +108,127 @@ class Task(object):
         assert(self._func is not None)
         return self._func(*self._args)
 
+    def __repr__(self):
+        return '<Task {0}>'.format(getattr(self._func, '__name__', self._func))
+
+
+
+class ShutdownReport(object):
+    """What became of the tasks of one processTasks(), each with its run time"""
+    def __init__(self):
+        self.completed = []     #(task, elapsed)
+        self.failed = []        #(task, exception, elapsed)
+        self.overran = []       #(task, elapsed), still running when left behind
+        self.skipped = []       #task, not started before the global timeout
+
+    def log(self):
+        for task, elapsed in self.overran:
+            logging.warning("at exit {0} overran, left behind after {1:.3f}s, timeout {2}"
+                            .format(task, elapsed, task.timeout))
+        for task, exception, elapsed in self.failed:
+            logging.error("at exit {0} failed after {1:.3f}s: {2!r}".format(task, elapsed, exception))
+        if self.skipped:
+            logging.warning("at exit {0} tasks skipped past the timeout".format(len(self.skipped)))
+
+
+
+class _TaskGroup(object):
+    """The tasks of one priority, run in parallel"""
+    def __init__(self, tasks, max_workers, deadline, report):
+        self.pending = deque(tasks)
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self.report = report
+        self.convar = threading.Condition(threading.Lock())
+        #key -> (task, start) of the tasks running and not left behind
+        self.running = {}
+        self.keys = itertools.count()
+        self.n_workers = 0
+
+    def run(self):
+        with self.convar:
+            self._spawn()
+            #the workers too, at exit one still running races the interpreter teardown
+            while self.pending or self.running or self.n_workers:
+                now = monotonic()
+                if self.deadline.expired():
+                    for task, start in self.running.values():
+                        self.report.overran.append((task, now - start))
+                    self.running.clear()
+                    self.report.skipped.extend(self.pending)
+                    self.pending.clear()
+                    break
+
+                wait_time = self.deadline.remaining()
+                for key, (task, start) in list(self.running.items()):
+                    if task.timeout is None:
+                        continue
+                    left_time = start + task.timeout - now
+                    if left_time <= 0:
+                        del self.running[key]
+                        self.n_workers -= 1
+                        self.report.overran.append((task, now - start))
+                    elif wait_time is None or left_time < wait_time:
+                        wait_time = left_time
+                #replace the workers stuck in tasks left behind
+                self._spawn()
+                if self.pending or self.running or self.n_workers:
+                    self.convar.wait(wait_time)
+
+    def _spawn(self):
+        n_spawn = min(self.max_workers, len(self.pending)) - self.n_workers
+        for i in range(n_spawn):
+            worker = threading.Thread(target=self._work, name='AtExitWorker')
+            worker.daemon = True
+            worker.start()
+        self.n_workers += max(n_spawn, 0)
+
+    def _work(self):
+        while True:
+            with self.convar:
+                if not self.pending:
+                    self.n_workers -= 1
+                    self.convar.notify()
+                    return
+                task = self.pending.popleft()
+                key = next(self.keys)
+                start = monotonic()
+                self.running[key] = (task, start)
+                if task.timeout is not None:
+                    #for run() to wait no longer than the timeout
+                    self.convar.notify()
+
+            exception = None
+            try:
+                task()
+            except BaseException as e:
+                #SystemExit too, the task failed and the worker goes on
+                exception = e
+
+            with self.convar:
+                if self.running.pop(key, None) is None:
+                    #left behind and replaced
+                    return
+                elapsed = monotonic() - start
+                if exception is None:
+                    self.report.completed.append((task, elapsed))
+                else:
+                    self.report.failed.append((task, exception, elapsed))
+                self.convar.notify()
+
 
 
 class AtExitManager(object):
-    def __init__(self, mutex=None) :
+    def __init__(self, mutex=None, timeout=None, max_workers=16, auto_install=False):
         self._mutex = mutex or threading.Lock()
         self._stack = Stack(self._mutex)
+        #of the processing by atexit or SIGTERM
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self._auto_install = auto_install
+        self._installed = False
+        self._previous_handlers = {}
+        self._signal_thread = None
 
     def __len__(self):
         return self._stack.size()
@@ -83,24 +236,92 @@ class AtExitManager(object):
     def size(self):
         return len(self)
 
-    def registerCallback(self, func, *args):
-        self._stack.push(Task(func, *args))
-
-    def registerTask(self, task):
-        self._stack.push(task)
-
-    def processTasks(self):
-        #the self._stack is blocked, when processTasks runs
+    def registerCallback(self, func, *args, **options):
+        """
+        Register func(*args), `priority` and `timeout` may be given as keywords.
+        Return the handle to unregister it.
+        """
+        task = Task(func, *args)
+        return self.registerTask(task, **options)
+
+    def registerTask(self, task, priority=None, timeout=None):
+        if priority is not None:
+            task.priority = priority
+        if timeout is not None:
+            task.timeout = timeout
+        if self._auto_install and not self._installed:
+            self.install()
+        return self._stack.push(task)
+
+    def unregister(self, handle):
+        """Remove a task not processed yet, return False if it was processed already"""
+        return self._stack.remove(handle)
+
+    def install(self, signums=(signal.SIGTERM,)):
+        """Process the tasks at exit and on the signals, once"""
+        if self._installed:
+            return
+        self._installed = True
+        atexit.register(self._process_at_exit)
+        for signum in signums:
+            try:
+                self._previous_handlers[signum] = signal.signal(signum, self._on_signal)
+            except ValueError:
+                #only the main thread can set a signal handler
+                logging.warning("AtExitManager not hooked to signal {0} out of the main thread"
+                                .format(signum))
+
+    def _process_at_exit(self):
+        if self._signal_thread is not None:
+            #the processing started by a signal goes first
+            self._signal_thread.join()
+        self.processTasks(self.timeout).log()
+
+    def _on_signal(self, signum, frame):
+        #never waits here for the lock of the stack, the interrupted frame
+        #may hold it: a thread processes the tasks then signals again, to
+        #the previous handler set back meanwhile
+        previous = self._previous_handlers.get(signum)
+        if previous is None:
+            previous = signal.SIG_DFL
+        signal.signal(signum, previous)
+        self._signal_thread = threading.Thread(
+            target=self._process_on_signal, args=(signum, previous), name='AtExitSignal')
+        self._signal_thread.start()
+
+    def _process_on_signal(self, signum, previous):
+        self.processTasks(self.timeout).log()
+        if previous != signal.SIG_IGN:
+            os.kill(os.getpid(), signum)
+
+    def processTasks(self, timeout=None, max_workers=None):
+        """
+        Run the tasks registered so far, by priority and in parallel within
+        a priority, for at most `timeout` seconds. Return a ShutdownReport.
+        """
+        deadline = Deadline(timeout)
+        report = ShutdownReport()
+        groups = {}
         for task in self._stack:
-            task()
+            groups.setdefault(task.priority, []).append(task)
+        for priority in sorted(groups):
+            if deadline.expired():
+                report.skipped.extend(groups[priority])
+                continue
+            _TaskGroup(groups[priority], max_workers or self.max_workers, deadline, report).run()
+        return report
 
     def __call__(self):
-        self.processTasks()
+        return self.processTasks()
 
 
-global_manager = AtExitManager()
+global_manager = AtExitManager(auto_install=True)
 
 if __name__ == "__main__":
+    import sys
+    import time
+    import subprocess
+
     def func(*args):
         print args
     task = Task(func, 1, 2, 3)
@@ -111,11 +332,40 @@ if __name__ == "__main__":
     with ScopedLock(mutex):
         assert(mutex.locked())
     assert(mutex.locked() is False)
+    #an exception goes through, a lock held elsewhere is left alone
+    try:
+        with ScopedLock(mutex):
+            raise KeyError('propagated')
+    except KeyError:
+        pass
+    else:
+        assert False, "KeyError expected"
+    assert(mutex.locked() is False)
+    mutex.acquire()
+    guarded = ScopedLock(mutex)
+    del guarded
+    assert(mutex.locked())
+    mutex.release()
 
     stack = Stack(mutex)
     del mutex
     del stack
 
+    #LIFO, O(1) removal, a drain leaves what is pushed meanwhile
+    stack = Stack(threading.Lock(), range(3))
+    handles = [stack.push(i) for i in xrange(3, 100000)]
+    for handle in handles[1::2]:
+        assert stack.remove(handle)
+    assert not stack.remove(handles[1])
+    assert len(stack) == 50002 and stack.pop() == 99999
+    drained = []
+    for item in stack:
+        if len(drained) == 0:
+            stack.push('pushed while draining')
+        drained.append(item)
+    assert drained[:3] == [99997, 99995, 99993] and drained[-5:] == [5, 3, 2, 1, 0]
+    assert list(stack) == ['pushed while draining']
+
     at = global_manager
     at.registerCallback(func, 1)
     at.registerTask(Task(func, 2))
@@ -123,3 +373,77 @@ if __name__ == "__main__":
     assert(at.size() == 2)
     at()
 
+    at = AtExitManager()
+    handle = at.registerCallback(func, 'unregistered')
+    at.registerCallback(func, 'kept')
+    assert at.unregister(handle) and not at.unregister(handle)
+    assert len(at) == 1 and len(at.processTasks().completed) == 1
+
+    #a priority runs in parallel, after the lower priorities
+    order = []
+    def slow(name, seconds):
+        time.sleep(seconds)
+        order.append(name)
+    at = AtExitManager()
+    for i in range(4):
+        at.registerCallback(slow, 'first', 0.2)
+    at.registerCallback(slow, 'second', 0, priority=1)
+    start = monotonic()
+    report = at.processTasks()
+    assert monotonic() - start < 0.35
+    assert order == ['first'] * 4 + ['second'] and len(report.completed) == 5
+
+    #a task overrunning its timeout is left behind, not waited for, and its
+    #thread replaced; the global timeout skips what did not start
+    def fail():
+        raise ValueError('failing')
+    at = AtExitManager()
+    at.registerCallback(slow, 'stuck', 1, timeout=0.1)
+    at.registerCallback(fail)
+    at.registerCallback(slow, 'after', 0.05, priority=1)
+    at.registerCallback(slow, 'stuck again', 1, priority=2)
+    at.registerCallback(slow, 'never', 0, priority=3)
+    start = monotonic()
+    report = at.processTasks(timeout=0.4, max_workers=1)
+    assert 0.4 <= monotonic() - start < 0.6
+    assert [task for task, elapsed in report.completed] and len(report.completed) == 1
+    assert [str(e) for task, e, elapsed in report.failed] == ['failing']
+    assert [elapsed >= 0.1 for task, elapsed in report.overran] == [True, True]
+    assert len(report.skipped) == 1 and len(at) == 0
+
+    #a callback calling sys.exit() fails, the others still run
+    at = AtExitManager()
+    at.registerCallback(sys.exit, 1)
+    at.registerCallback(slow, 'after exit', 0)
+    report = at.processTasks(timeout=5)
+    assert [type(e) for task, e, elapsed in report.failed] == [SystemExit]
+    assert len(report.completed) == 1 and not report.overran
+
+    #processed at exit and before dying on SIGTERM
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = '''if True:
+        import os, sys, signal, time
+        from AtExitManager import global_manager
+        def done(name):
+            sys.stdout.write(name)
+            sys.stdout.flush()
+        global_manager.registerCallback(done, 'done')
+        if sys.argv[1] == 'kill':
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(5)
+        elif sys.argv[1] == 'kill locked':
+            #used to deadlock, the handler waited for the lock held here
+            with global_manager._mutex:
+                os.kill(os.getpid(), signal.SIGTERM)
+                time.sleep(0.2)
+            time.sleep(5)
+    '''
+    for how, returncode in (('exit', 0), ('kill', -signal.SIGTERM), ('kill locked', -signal.SIGTERM)):
+        child = subprocess.Popen([sys.executable, '-c', script, how], cwd=here, stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        assert output == 'done' and child.returncode == returncode, (how, output, child.returncode)
+
+    #the overrunning tasks left behind end before the interpreter does
+    for thread in threading.enumerate():
+        if thread.name == 'AtExitWorker':
+            thread.join(5)
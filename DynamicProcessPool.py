@@ -0,0 +1,624 @@
+#!/usr/bin/env python
+#-*- encoding:utf-8 -*-
+"""
+DynamicProcessPool is a drop-in of DynamicThreadPool whose workers are processes,
+so CPU-bound tasks are not serialized by the GIL.
+e.g.
+    def func(i):
+        return i * i
+
+    pool = DynamicProcessPool(4, 10)
+    future = pool.post_task(func, 2)
+    print future.result()
+    print list(pool.map(func, range(100), chunksize=10))
+
+    pool.terminate()
+
+Like DynamicThreadPool, a worker process is spawned when tasks are pending and
+fewer than `max_worker_threads` workers exist, and each one exits after
+`max_idle_before_exit` seconds without a task. post_task(), submit(),
+post_many(), map() and terminate() behave the same and return the same Future.
+
+Tasks are sent in batches: post_many() splits its calls into one batch per
+worker, a batch is pickled once by the caller and its results come back in one
+message. func, args and results must be picklable, so func must be defined at
+the module level. A worker is sent one batch at a time, the others wait in the
+pool, where cancel() can still drop their tasks.
+
+SharedBytes(data) passes a large byte payload through a file on /dev/shm
+instead of the pipe: only its path is pickled and the worker maps the file,
+shared.view() reads it without a copy. Pass it as a positional argument, the
+pool unlinks the file once the task is done. A func may return SharedBytes too.
+
+With `max_tasks_per_worker`, a worker process exits after running that many
+tasks and a fresh one takes over the pending batches.
+
+A worker process killed from outside, e.g. by the OOM killer, fails the tasks
+of the batch it was running with WorkerDied, and is replaced on demand.
+"""
+import os
+import sys
+import mmap
+import signal
+import time
+import tempfile
+import itertools
+import multiprocessing
+import multiprocessing.queues
+
+from threading import Thread
+from collections import deque
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from DynamicThreadPool import DynamicThreadPool, Full, DeadlineExpired, CancelledError
+from timetools import monotonic, Deadline
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+
+class SharedBytes(object):
+    """
+    A byte payload stored in a shared memory file, pickled by path.
+    The creator side unlinks the file once the payload has been delivered.
+    """
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+    def __init__(self, data=None, path=None):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='pool-', dir=self.shm_dir)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        self.path = path
+        self.size = os.path.getsize(path)
+        self._map = None
+
+    def __reduce__(self):
+        return (SharedBytes, (None, self.path))
+
+    def __len__(self):
+        return self.size
+
+    def view(self):
+        """A read-only, zero copy view of the payload"""
+        if self._map is None:
+            if not self.size:
+                return memoryview(b'')
+            with open(self.path, 'rb') as infile:
+                self._map = mmap.mmap(infile.fileno(), self.size, access=mmap.ACCESS_READ)
+        try:
+            return memoryview(self._map)
+        except TypeError:
+            #python2 mmap only supports the old buffer interface
+            return buffer(self._map)
+
+    def tobytes(self):
+        return bytes(self.view())
+
+    def unlink(self):
+        """Remove the file, an existing view stays readable"""
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _run_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+
+class WorkerDied(Exception):
+    """The worker process running the task died, e.g. killed from outside"""
+
+
+#how often the collector looks for exited and idle workers, in seconds
+_REAP_INTERVAL = 0.1
+
+
+def _worker_main(conn, writer, result_queue):
+    #the pool holds the only writer, its exit ends recv_bytes() with EOFError
+    writer.close()
+    pid = os.getpid()
+    while True:
+        try:
+            batch = conn.recv_bytes()
+        except EOFError:
+            break
+        if not batch:
+            #retired by the pool
+            break
+
+        tasks = pickle.loads(batch)
+        results = []
+        escaped = None
+        #the monotonic clock is system wide, deadlines of the parent hold here
+        for task_id, func, args, kwargs, deadline in tasks:
+            if deadline is not None and monotonic() > deadline:
+                results.append((task_id, None, DeadlineExpired(
+                    "task {0} expired {1:.3f}s ago".format(func, monotonic() - deadline))))
+                continue
+            try:
+                results.append((task_id, func(*args, **kwargs), None))
+            except BaseException as exc:
+                results.append((task_id, None, exc))
+                if not isinstance(exc, Exception):
+                    #SystemExit and the like still end the worker, like PendingTask,
+                    #the pool sends the rest of the batch to another one
+                    escaped = exc
+                    break
+        #the ids travel outside the pickle of the results, for the pool to
+        #fail them if it can not unpickle it after all
+        task_ids = [task_id for task_id, result, exc in results]
+        result_queue.put((pid, task_ids, _dumps_results(results), escaped is not None))
+        if escaped is not None:
+            raise escaped
+
+
+def _dumps_results(results):
+    """Pickle the results, those that do not come back from pickle replaced by an error"""
+    try:
+        data = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+        pickle.loads(data)
+        return data
+    except Exception:
+        return pickle.dumps([_picklable_result(result) for result in results],
+                            pickle.HIGHEST_PROTOCOL)
+
+
+def _picklable_result(result):
+    #e.g. an exception whose __init__ takes other arguments than its args
+    try:
+        pickle.loads(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        return result
+    except Exception as exc:
+        return (result[0], None, pickle.PicklingError(
+            "result of task can not be pickled: {0!r}".format(exc)))
+
+
+class _Batch(object):
+    """Tasks sent to a worker in one message"""
+    __slots__ = ('tasks', 'data')
+
+    def __init__(self, tasks):
+        #[(task_id, func, args, kwargs, deadline)]
+        self.tasks = tasks
+        #raises here, in the caller, if anything can not be pickled
+        self.data = pickle.dumps(tasks, pickle.HIGHEST_PROTOCOL)
+
+
+class _WorkerProcess(object):
+    """A worker process seen from the pool, with the batch it runs if any"""
+    __slots__ = ('process', 'conn', 'batch', 'n_tasks', 'idle_since', 'retired')
+
+    def __init__(self, result_queue):
+        reader, self.conn = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               args=(reader, self.conn, result_queue))
+        self.process.daemon = True
+        self.process.start()
+        #the worker holds the only reader, writing to it once it died fails
+        reader.close()
+        self.batch = None
+        self.n_tasks = 0
+        self.idle_since = monotonic()
+        self.retired = False
+
+    def send(self, batch):
+        """Send the batch, False if the worker died"""
+        try:
+            self.conn.send_bytes(batch.data)
+        except (IOError, OSError):
+            self.retired = True
+            return False
+        self.batch = batch
+        return True
+
+    def retire(self):
+        self.retired = True
+        try:
+            self.conn.send_bytes(b'')
+        except (IOError, OSError):
+            pass
+
+
+class DynamicProcessPool(DynamicThreadPool):
+    def __init__(self, max_worker_threads, max_idle_before_exit, max_capacity=0, low_watermark=None,
+                 error_handler=None, max_tasks_per_worker=0):
+        super(DynamicProcessPool, self).__init__(
+            max_worker_threads, max_idle_before_exit, max_capacity, low_watermark,
+            error_handler=error_handler, max_tasks_per_worker=max_tasks_per_worker)
+        self.result_queue = multiprocessing.Queue()
+        self.collector = None
+
+        self.task_ids = itertools.count()
+        self.running_tasks = {}
+        #pid -> _WorkerProcess, until the collector sees the process exited
+        self.workers = {}
+        #batches waiting for an idle worker, the one in flight is held by its worker
+        self.batches = deque()
+        #tasks and batches posted and not answered yet
+        self.n_pending_tasks = 0
+        self.n_pending_batches = 0
+
+    def map(self, func, iterable, chunksize=1, timeout=None):
+        if chunksize < 1:
+            raise ValueError("chunksize must be >= 1, given({0})".format(chunksize))
+
+        it = iter(iterable)
+        chunks = iter(lambda: list(itertools.islice(it, chunksize)), [])
+        futures = self.post_many((_run_chunk, (func, chunk)) for chunk in chunks)
+
+        def results():
+            deadline = Deadline(timeout)
+            for future in futures:
+                for result in future.result(deadline.remaining()):
+                    yield result
+        return results()
+
+    def _post_task(self, task, block=True, timeout=None):
+        if not self._post_tasks([task], block, timeout):
+            raise Full
+        return True
+
+    def _post_tasks(self, tasks, block=True, timeout=None):
+        deadline = Deadline(timeout)
+        n_posted = 0
+        with self.mutex as lock:
+            while n_posted < len(tasks):
+                if not self.accepting:
+                    try:
+                        self._wait_accepting(block, deadline.remaining())
+                    except Full:
+                        break
+
+                n_batch = len(tasks) - n_posted
+                if self.max_capacity:
+                    n_batch = min(n_batch, self.max_capacity - self.n_pending_tasks)
+                self._send(tasks[n_posted:n_posted + n_batch])
+                n_posted += n_batch
+                if self.max_capacity and self.n_pending_tasks >= self.max_capacity:
+                    self.accepting = False
+        return n_posted
+
+    def _send(self, tasks):
+        """Split the tasks into a batch per worker, pickle each one and dispatch them"""
+        n_batches = min(len(tasks), self.max_worker_threads)
+        batch_size = -(-len(tasks) // n_batches)
+        for start in xrange(0, len(tasks), batch_size):
+            batch = _Batch([(next(self.task_ids), task.func, task.args, task.kwargs, task.deadline)
+                            for task in tasks[start:start + batch_size]])
+            for (task_id, func, args, kwargs, deadline), task in zip(batch.tasks, tasks[start:]):
+                self.running_tasks[task_id] = task
+            self.n_pending_tasks += len(batch.tasks)
+            self.n_pending_batches += 1
+            self.batches.append(batch)
+        self._dispatch()
+
+    def _dispatch(self):
+        """
+        Called with the mutex held. Send the waiting batches to the idle
+        workers, one each, spawning workers for the others.
+        """
+        idle = [worker for worker in self.workers.values()
+                if worker.batch is None and not worker.retired]
+        n_spawn = min(self.max_worker_threads - self.n_spawned_threads,
+                      len(self.batches) - len(idle))
+        for i in xrange(n_spawn):
+            worker = _WorkerProcess(self.result_queue)
+            self.workers[worker.process.pid] = worker
+            self.n_spawned_threads += 1
+            idle.append(worker)
+        while self.batches and idle:
+            batch = self.batches.popleft()
+            if not idle.pop().send(batch):
+                #died meanwhile, the collector counts it gone
+                self.batches.appendleft(batch)
+        if self.terminated and not self.batches:
+            for worker in idle:
+                worker.retire()
+
+        if self.collector is None and self.workers:
+            self.collector = Thread(target=self._collect)
+            self.collector.daemon = True
+            self.collector.start()
+
+    def _collect(self):
+        next_reap = monotonic() + _REAP_INTERVAL
+        while True:
+            try:
+                message = self.result_queue.get(True, max(next_reap - monotonic(), 0))
+            except multiprocessing.queues.Empty:
+                pass
+            else:
+                self._answer(message)
+            if monotonic() >= next_reap:
+                if not self._reap():
+                    return
+                next_reap = monotonic() + _REAP_INTERVAL
+
+    def _answer(self, message):
+        pid, task_ids, data, exiting = message
+        try:
+            results = pickle.loads(data)
+        except Exception as exc:
+            #fails this batch only, the collector goes on
+            error = pickle.UnpicklingError("results of tasks can not be unpickled: {0!r}".format(exc))
+            results = [(task_id, None, error) for task_id in task_ids]
+        with self.mutex as lock:
+            worker = self.workers[pid]
+            batch, worker.batch = worker.batch, None
+            tasks = [self.running_tasks.pop(task_id) for task_id, result, exc in results]
+            self.n_pending_tasks -= len(results)
+            self.n_pending_batches -= 1
+            if exiting:
+                worker.retired = True
+            if len(results) < len(batch.tasks):
+                #cut short by a task exiting the worker, the rest is a new batch
+                self.batches.appendleft(_Batch(batch.tasks[len(results):]))
+                self.n_pending_batches += 1
+            worker.n_tasks += len(results)
+            worker.idle_since = monotonic()
+            if self.max_tasks_per_worker and worker.n_tasks >= self.max_tasks_per_worker:
+                worker.retire()
+            self._reopen()
+            self._dispatch()
+        self._resolve(tasks, results)
+
+    def _reap(self):
+        """
+        Count the exited workers gone, failing the batch they were running,
+        and retire the idle ones. Return False once no worker is left.
+        """
+        exited = [worker for worker in list(self.workers.values())
+                  if worker.process.exitcode is not None]
+        #what they sent is in the queue before they exit, answered first
+        while exited:
+            try:
+                message = self.result_queue.get_nowait()
+            except multiprocessing.queues.Empty:
+                break
+            self._answer(message)
+
+        lost = []
+        with self.mutex as lock:
+            for worker in exited:
+                del self.workers[worker.process.pid]
+                self.n_spawned_threads -= 1
+                worker.conn.close()
+                batch = worker.batch
+                if batch is None:
+                    continue
+                error = WorkerDied("worker process {0} exited with code {1}".format(
+                    worker.process.pid, worker.process.exitcode))
+                results = [(task_id, None, error) for task_id, func, args, kwargs, deadline in batch.tasks]
+                lost.append(([self.running_tasks.pop(task_id) for task_id, result, exc in results],
+                             results))
+                self.n_pending_tasks -= len(results)
+                self.n_pending_batches -= 1
+            self._reopen()
+
+            now = monotonic()
+            for worker in self.workers.values():
+                if (worker.batch is None and not worker.retired
+                        and now - worker.idle_since >= self.max_idle_before_exit):
+                    worker.retire()
+            #replaces the workers gone for the batches waiting
+            self._dispatch()
+            if not self.workers:
+                self.collector = None
+        for tasks, results in lost:
+            self._resolve(tasks, results)
+        return self.collector is not None
+
+    def _reopen(self):
+        """Called with the mutex held, tasks were answered or cancelled"""
+        if not self.accepting and self.n_pending_tasks <= self.low_watermark:
+            self.accepting = True
+            self.not_full_convar.notify(self.max_capacity - self.n_pending_tasks)
+
+    def _resolve(self, tasks, results):
+        for task, (task_id, result, exc) in zip(tasks, results):
+            for arg in task.args:
+                if isinstance(arg, SharedBytes):
+                    arg.unlink()
+            if isinstance(result, SharedBytes):
+                #map it before the file goes away
+                result.view()
+                result.unlink()
+            task.future._set(result, exc)
+            if exc is not None and self.error_handler is not None:
+                self._handle_error(task)
+
+    def cancel(self, future):
+        """
+        Cancel the task of `future` if it waits for a worker, its future
+        raises CancelledError. Return False if it was sent to a worker or is done.
+        """
+        with self.mutex as lock:
+            found = [(i, j) for i, batch in enumerate(self.batches)
+                     for j, entry in enumerate(batch.tasks)
+                     if self.running_tasks[entry[0]].future is future]
+            if not found:
+                return False
+            i, j = found[0]
+            tasks = list(self.batches[i].tasks)
+            task_id = tasks.pop(j)[0]
+            if tasks:
+                self.batches[i] = _Batch(tasks)
+            else:
+                del self.batches[i]
+                self.n_pending_batches -= 1
+            del self.running_tasks[task_id]
+            self.n_pending_tasks -= 1
+            self._reopen()
+        future._set(exception=CancelledError())
+        return True
+
+    def pending_size(self):
+        return self.n_pending_tasks
+
+    def terminate(self):
+        with self.mutex as lock:
+            if self.terminated:
+                return
+            self.terminated = True
+            #the idle workers exit now, the busy ones once no batch waits
+            self._dispatch()
+
+
+def burn(n):
+    """A CPU-bound task for the benchmark"""
+    total = 0
+    for i in xrange(n):
+        total += i * i
+    return total
+
+
+def benchmark(pool_class, n_tasks=64, n_workers=4, n_loops=200000):
+    """Return the seconds `pool_class` takes to run `n_tasks` CPU-bound tasks"""
+    pool = pool_class(n_workers, 1)
+    start = monotonic()
+    for future in pool.post_many([(burn, (n_loops,))] * n_tasks):
+        future.result()
+    elapsed = monotonic() - start
+    pool.terminate()
+    return elapsed
+
+
+def payload_size(shared):
+    return len(shared.view())
+
+
+def faulty(i):
+    """A task failing now and then, exiting its worker once in a while"""
+    if i % 7 == 0:
+        raise ValueError(i)
+    if i % 101 == 0:
+        sys.exit(i)
+    return i
+
+
+def kill_self():
+    """A task killing its worker like the OOM killer would"""
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+class UnpicklableError(Exception):
+    def __init__(self, a, b):
+        super(UnpicklableError, self).__init__(a + b)
+
+
+def raise_unpicklable():
+    raise UnpicklableError(1, 2)
+
+
+def make_payload(size):
+    return SharedBytes(b'x' * size)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['bench']:
+        for pool_class in (DynamicThreadPool, DynamicProcessPool):
+            print('{0}: {1:.2f}s'.format(pool_class.__name__, benchmark(pool_class)))
+        time.sleep(1.5)
+        sys.exit(0)
+
+    pool = DynamicProcessPool(4, 0.5)
+    assert pool.post_task(burn, 10).result(10) == burn(10)
+    assert list(pool.map(burn, range(50), chunksize=7)) == list(map(burn, range(50)))
+    futures = pool.post_many([(burn, (i,)) for i in range(20)] + [(burn, ('x',))])
+    assert [f.result(10) for f in futures[:20]] == list(map(burn, range(20)))
+    assert isinstance(futures[-1].exception(10), TypeError)
+    assert 0 < pool.n_spawned_threads <= 4
+
+    shared = SharedBytes(b'abc' * 100000)
+    assert pool.post_task(payload_size, shared).result(10) == 300000
+    assert not os.path.exists(shared.path)
+    result = pool.post_task(make_payload, 1000).result(10)
+    assert result.tobytes() == b'x' * 1000 and not os.path.exists(result.path)
+
+    #idle workers exit, the pool grows again on demand
+    time.sleep(1.5)
+    assert pool.n_spawned_threads == 0 and pool.collector is None
+    assert pool.post_task(burn, 3).result(10) == burn(3)
+
+    errors = []
+    recycled = DynamicProcessPool(2, 0.5, max_tasks_per_worker=3,
+                                  error_handler=lambda task, exc: errors.append(exc))
+    futures = [recycled.post_task(burn, i if i % 4 else 'x') for i in range(40)]
+    assert [f.result(10) for f in futures if not f.exception(10)] == [burn(i) for i in range(40) if i % 4]
+    assert len(errors) == 10 and all(isinstance(exc, TypeError) for exc in errors)
+    recycled.terminate()
+
+    bounded = DynamicProcessPool(1, 0.5, max_capacity=2)
+    bounded.post_many([(time.sleep, (0.3,))] * 2)
+    try:
+        bounded.post_task_nowait(burn, 1)
+    except Full:
+        pass
+    else:
+        assert False, "Full expected"
+    assert bounded.post_task(burn, 2).result(10) == burn(2)
+    bounded.post_task(time.sleep, 0.3)
+    expired = bounded.submit(burn, (1,), deadline=0.1)
+    assert isinstance(expired.exception(10), DeadlineExpired)
+
+    #an exception that pickles but does not unpickle fails its task only
+    futures = pool.post_many([(raise_unpicklable, ()), (abs, (-1,))])
+    assert isinstance(futures[0].exception(10), pickle.PicklingError)
+    assert futures[1].result(10) == 1 and pool.post_task(abs, -2).result(10) == 2
+
+    #a task exiting its worker gets the SystemExit, the rest of its batch
+    #runs in another worker and the pool counts the worker gone
+    exiting = DynamicProcessPool(1, 0.3)
+    futures = exiting.post_many([(abs, (-1,)), (sys.exit, (3,)), (abs, (-2,)), (abs, (-3,))])
+    assert futures[0].result(10) == 1 and isinstance(futures[1].exception(10), SystemExit)
+    assert [f.result(10) for f in futures[2:]] == [2, 3]
+    time.sleep(1)
+    assert exiting.n_spawned_threads == 0 and exiting.n_pending_batches == 0
+    assert exiting.post_task(abs, -4).result(10) == 4
+    exiting.terminate()
+
+    #the fault injection of DynamicThreadPool: no future left pending, no worker left counted
+    for max_tasks_per_worker in (0, 5):
+        errors = []
+        faulted = DynamicProcessPool(4, 0.3, max_tasks_per_worker=max_tasks_per_worker,
+                                     error_handler=lambda task, exc: errors.append(exc))
+        futures = [faulted.post_task(faulty, i) for i in range(1, 500)]
+        assert [f.result(10) for f in futures if not f.exception(10)] == \
+            [i for i in range(1, 500) if i % 7 and i % 101]
+        assert len(errors) == len([i for i in range(1, 500) if i % 7 == 0 or i % 101 == 0])
+        time.sleep(1)
+        assert faulted.n_spawned_threads == 0 and faulted.n_pending_batches == 0
+        assert faulted.post_task(faulty, 1).result(10) == 1
+        faulted.terminate()
+
+    #a worker killed from outside fails the batch it ran, and is replaced
+    killed = DynamicProcessPool(2, 5)
+    futures = [killed.post_task(kill_self) for i in range(2)]
+    assert all(isinstance(f.exception(10), WorkerDied) for f in futures)
+    assert killed.post_task(abs, -1).result(10) == 1
+    assert killed.n_spawned_threads == 1 and killed.n_pending_batches == 0 and killed.n_pending_tasks == 0
+    killed.terminate()
+
+    #a task waiting for a worker can be cancelled, not a running one
+    single = DynamicProcessPool(1, 0.5)
+    running = single.post_task(time.sleep, 0.3)
+    waiting = single.post_many([(abs, (-1,)), (abs, (-2,))])
+    assert not single.cancel(running)
+    assert single.cancel(waiting[0]) and waiting[0].cancelled() and not single.cancel(waiting[0])
+    assert waiting[1].result(10) == 2 and running.result(10) is None
+    assert single.n_pending_tasks == 0 and single.n_pending_batches == 0
+    single.terminate()
+
+    bounded.terminate()
+    pool.terminate()
+    time.sleep(0.5)
@@ -4,7 +4,7 @@
 DynamicThreadPool is a pool of dynamic non-joinable threads.
 e.g.
     def func(i):
-        print i
+        print(i)
 
     pool = DynamicThreadPool(2, 10)
     for i in range(100):
@@ -14,24 +14,61 @@ e.g.
 
 `max_worker_threads` threads to work, and each one keep alive `max_idle_before_exit` seconds at least.
 post_task() method will add a task, and run it as soon as possible.
+It returns a Future: future.result(timeout), future.exception(timeout) and
+future.add_done_callback(fn) read the outcome, wait() and as_completed()
+work across many futures. pool.cancel(future) drops a task still pending.
 terminate() method will exit all threads at idle, but busy threads will run to end.
 
-TODO:
-`max_capacity` is planned to limit the max tasks to put at the same time.
+DynamicThreadPool(..., prioritized=True) keeps pending tasks in a heap instead of
+a deque, so submit(func, args, priority=p) is run before tasks of higher `p`.
+submit(func, args, deadline=d) drops the task if no worker starts it within `d`
+seconds, its future raises DeadlineExpired.
+
+`max_capacity` limits the tasks pending at the same time. post_task() blocks
+while the pool is full, post_task_nowait() raises Full, and
+submit(func, args, kwargs, block, timeout) covers both plus timeouts.
+With `low_watermark`, a full pool accepts tasks again only once the workers
+have drained it down to `low_watermark`, so blocked producers are woken in
+one batch instead of one per freed slot.
+
+WorkStealingThreadPool is a drop-in scheduler mode of DynamicThreadPool:
+each worker owns a deque, posts are spread across those deques without taking
+the pool mutex, and idle workers steal from busy ones. The mutex is only taken
+to spawn, park or retire a worker.
+
+A task raising an exception only resolves its future with it, and
+`error_handler(task, exc)` is called if given. With `max_tasks_per_worker`,
+a worker exits after running that many tasks and is replaced on demand,
+which bounds what a leaking task can pile up in a thread.
 
 Known:
 Python does not surpport the multi-thread concept as the pthread library in linux,
 all threads work only in one Process. :<)
 """
+from __future__ import print_function
+
 import os
 import time
+import heapq
+import random
+import itertools
 import logging
 
 from collections import deque
 from threading import Thread
-from threading import RLock as Mutex   
+from threading import current_thread
+from threading import Event
+from threading import Lock
+from threading import RLock as Mutex
 from threading import Condition as ConVar
 
+from timetools import monotonic, Deadline
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
 
 class Empty(Exception):
     """Queue Empty Exception"""
@@ -67,18 +104,400 @@ class Queue(object):
         return self._size
 
     def capacity(self):
-        return self.max_capacity
+        return self._max_capacity
+
+    def remove_task_of(self, future):
+        """Remove and return the task of `future`, None if it is not queued"""
+        for task in self._queue:
+            if task.future is future:
+                self._queue.remove(task)
+                self._size -= 1
+                return task
+        return None
+
+
+class PriorityQueue(Queue):
+    """
+    Queue popping the item of the lowest `priority` first,
+    items of the same priority in the order they were put.
+    """
+    def __init__(self, max_capacity=0):
+        super(PriorityQueue, self).__init__(max_capacity)
+        self._queue = []
+        self._seq = itertools.count()
+
+    def pop(self):
+        if not self._size:
+            raise Empty
+        self._size -= 1
+        return heapq.heappop(self._queue)[-1]
+
+    def put(self, item):
+        if self._max_capacity and self._size >= self._max_capacity:
+            raise Full
+        heapq.heappush(self._queue, (item.priority, next(self._seq), item))
+        self._size += 1
+        return self._size
+
+    def remove_task_of(self, future):
+        for i, entry in enumerate(self._queue):
+            if entry[-1].future is future:
+                self._queue[i] = self._queue[-1]
+                self._queue.pop()
+                heapq.heapify(self._queue)
+                self._size -= 1
+                return entry[-1]
+        return None
+
+
+class DeadlineExpired(Exception):
+    """The task was not started before its deadline"""
+
+
+class Histogram(object):
+    """
+    Durations counted in power-of-two buckets of microseconds:
+    bucket i holds the durations in [2**(i-1), 2**i) us, bucket 0 those under 1us.
+    """
+    N_BUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.N_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[min(int(seconds * 1e6).bit_length(), self.N_BUCKETS - 1)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Upper bound in seconds of the bucket holding the q-th percentile"""
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << i) / 1e6, self.max)
+        return 0.0
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'buckets': list(self.buckets)}
+
+
+class WorkerStats(object):
+    """Counters of one worker, only written by its own thread"""
+    def __init__(self):
+        self.queue_wait = Histogram()
+        self.run_time = Histogram()
+        self.completed = 0
+        self.failed = 0
+
+    def merge(self, other):
+        self.queue_wait.merge(other.queue_wait)
+        self.run_time.merge(other.run_time)
+        self.completed += other.completed
+        self.failed += other.failed
+
+
+class PoolStats(object):
+    """
+    Statistics of an instrumented pool. Every worker writes its own
+    WorkerStats without locking, snapshot() sums them with the ones of the
+    workers gone. Spawns, exits and lock contention are counted by the pool
+    under its mutex.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.live = set()
+        self.retired = WorkerStats()
+        self.threads_spawned = 0
+        self.threads_exited = 0
+
+    def register(self):
+        local = WorkerStats()
+        with self.lock as lock:
+            self.live.add(local)
+        return local
+
+    def unregister(self, local):
+        with self.lock as lock:
+            self.live.discard(local)
+            self.retired.merge(local)
+
+    def snapshot(self):
+        total = WorkerStats()
+        with self.lock as lock:
+            total.merge(self.retired)
+            for local in list(self.live):
+                total.merge(local)
+        return {'tasks_completed': total.completed,
+                'tasks_failed': total.failed,
+                'threads_spawned': self.threads_spawned,
+                'threads_exited': self.threads_exited,
+                'queue_wait': total.queue_wait.snapshot(),
+                'run_time': total.run_time.snapshot()}
+
+
+class ProfiledMutex(object):
+    """A Mutex counting the time spent waiting to acquire it"""
+    def __init__(self, mutex=None):
+        self._mutex = mutex or Mutex()
+        self.wait_time = 0.0
+        self.n_contended = 0
+        #Condition needs them to fully release a reentrant lock in wait()
+        for name in ('_release_save', '_acquire_restore', '_is_owned'):
+            if hasattr(self._mutex, name):
+                setattr(self, name, getattr(self._mutex, name))
+
+    def acquire(self, blocking=True):
+        if self._mutex.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = monotonic()
+        self._mutex.acquire()
+        #updated with the mutex held
+        self.wait_time += monotonic() - start
+        self.n_contended += 1
+        return True
+
+    def release(self):
+        self._mutex.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self._mutex.release()
+
+
+class TimeoutError(Exception):
+    """Future TimeoutError Exception"""
+
+
+class CancelledError(Exception):
+    """The task was cancelled before it started"""
+
+
+#only taken by readers of a Future (result/wait/callbacks), never by workers
+#setting a result nobody asked for
+_future_mutex = Lock()
+
+
+class Future(object):
+    """
+    The result of a posted task.
+
+    The worker just stores the outcome and flips `_done`; an Event and the
+    callbacks list are created only when somebody waits for or subscribes
+    to the result, so unread futures cost no locking at all.
+    """
+    __slots__ = ('_done', '_result', '_exception', '_event', '_callbacks')
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._event = None
+        self._callbacks = None
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return isinstance(self._exception, CancelledError)
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call fn(future) when done, at once if it is done already"""
+        with _future_mutex as lock:
+            if self._callbacks is None:
+                self._callbacks = []
+            self._callbacks.append(fn)
+            if not self._done:
+                return
+            #raced with _set(), run it here unless _set() has taken it
+            try:
+                self._callbacks.remove(fn)
+            except ValueError:
+                return
+        self._run_callback(fn)
+
+    def _wait(self, timeout):
+        if self._done:
+            return
+        with _future_mutex as lock:
+            if self._event is None:
+                self._event = Event()
+            event = self._event
+        #_set() flips _done before looking at _event, so rechecking after
+        #publishing the event can not miss the wakeup. Event.wait() of python2
+        #times out on the wall clock, waited again until the deadline
+        deadline = Deadline(timeout)
+        while not self._done:
+            if deadline.expired():
+                raise TimeoutError
+            event.wait(deadline.remaining())
+
+    def _set(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+        self._done = True
+        if self._event is not None:
+            self._event.set()
+        if self._callbacks is not None:
+            with _future_mutex as lock:
+                callbacks, self._callbacks = self._callbacks, []
+            for fn in callbacks:
+                self._run_callback(fn)
+
+    def _run_callback(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            logging.exception("exception calling callback for {0}".format(self))
+
+
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+FIRST_EXCEPTION = 'FIRST_EXCEPTION'
+ALL_COMPLETED = 'ALL_COMPLETED'
+
+
+class _Collector(object):
+    """Done callback gathering finished futures for wait/as_completed"""
+    def __init__(self):
+        self.convar = ConVar(Lock())
+        self.finished = []
+
+    def __call__(self, future):
+        with self.convar as lock:
+            self.finished.append(future)
+            self.convar.notify()
+
+
+def wait(futures, timeout=None, return_when=ALL_COMPLETED):
+    """
+    Wait for the futures, return a tuple of sets (done, not_done).
+    `return_when` is one of FIRST_COMPLETED, FIRST_EXCEPTION, ALL_COMPLETED.
+    """
+    futures = set(futures)
+    done = set(f for f in futures if f.done())
+    not_done = futures - done
+
+    def satisfied():
+        if not not_done:
+            return True
+        if return_when == FIRST_COMPLETED:
+            return bool(done)
+        if return_when == FIRST_EXCEPTION:
+            return any(f._exception is not None for f in done)
+        return False
+
+    if satisfied():
+        return done, not_done
+
+    collector = _Collector()
+    for f in not_done:
+        f.add_done_callback(collector)
+
+    deadline = Deadline(timeout)
+    with collector.convar as lock:
+        while True:
+            for f in collector.finished:
+                done.add(f)
+                not_done.discard(f)
+            del collector.finished[:]
+            if satisfied() or not deadline.wait(collector.convar):
+                break
+    return done, not_done
+
+
+def as_completed(futures, timeout=None):
+    """Yield the futures as they complete, raise TimeoutError at `timeout`"""
+    futures = set(futures)
+    pending = set(f for f in futures if not f.done())
+    for f in futures - pending:
+        yield f
+
+    collector = _Collector()
+    for f in pending:
+        f.add_done_callback(collector)
+
+    deadline = Deadline(timeout)
+    while pending:
+        with collector.convar as lock:
+            while not collector.finished:
+                if not deadline.wait(collector.convar):
+                    raise TimeoutError("{0} of {1} futures unfinished"
+                                       .format(len(pending), len(futures)))
+            finished, collector.finished = collector.finished, []
+        for f in finished:
+            if f in pending:
+                pending.discard(f)
+                yield f
 
 
 class PendingTask(object):
     """A task with a function, which the threads will work on"""
+    #set per instance only when the task was posted with them
+    priority = 0
+    deadline = None
+    #set by instrumented pools only
+    posted_at = None
+
     def __init__(self, func=None, *args, **kwargs):
         self.func = func
         self.args = args
         self.kwargs = kwargs
+        self.future = Future() if func is not None else None
+
+    @classmethod
+    def from_call(cls, call):
+        """Build a task from a callable, (func, args) or (func, args, kwargs)"""
+        if callable(call):
+            return cls(call)
+        kwargs = call[2] if len(call) > 2 else {}
+        return cls(call[0], *call[1], **kwargs)
 
     def __call__(self):
-        return self.func(*self.args, **self.kwargs)
+        if self.deadline is not None and monotonic() > self.deadline:
+            self.future._set(exception=DeadlineExpired(
+                "task {0} expired {1:.3f}s ago".format(self.func, monotonic() - self.deadline)))
+            return
+        try:
+            result = self.func(*self.args, **self.kwargs)
+        except BaseException as exc:
+            self.future._set(exception=exc)
+            if not isinstance(exc, Exception):
+                #SystemExit and the like still end the worker
+                raise
+        else:
+            self.future._set(result)
 
     def is_close_down(self):
         """
@@ -101,87 +520,594 @@ class Worker(Thread):
         worker.start()
         return worker
 
+    def next_task(self):
+        return self.pool.wait_task()
+
     def run(self):
         logging.debug("[{0}] thread starts".format(self.ident))
 
+        try:
+            #decided once, the plain loop pays nothing for instrumentation
+            if self.pool.stats is None:
+                self.run_tasks()
+            else:
+                self.run_tasks_instrumented(self.pool.stats)
+        finally:
+            #whatever happened, the pool must not count this thread any more
+            self.on_exit()
+        logging.debug("[{0}] thread ends".format(self.ident))
+
+    def run_tasks(self):
+        pool = self.pool
+        #counts down to 0 when recycling, from 0 it never gets there
+        n_tasks_left = pool.max_tasks_per_worker
         while True:
-            task = self.pool.wait_task()
+            task = self.next_task()
             if task.is_close_down():
                 break
             task()
+            if task.future._exception is not None and pool.error_handler is not None:
+                pool._handle_error(task)
+            n_tasks_left -= 1
+            if not n_tasks_left:
+                break
+
+    def run_tasks_instrumented(self, stats):
+        pool = self.pool
+        n_tasks_left = pool.max_tasks_per_worker
+        local = stats.register()
+        try:
+            while True:
+                task = self.next_task()
+                if task.is_close_down():
+                    break
 
+                start = monotonic()
+                if task.posted_at is not None:
+                    local.queue_wait.add(start - task.posted_at)
+                pool._call_hooks(pool.pre_task_hooks, task)
+                task()
+                local.run_time.add(monotonic() - start)
+                if task.future._exception is None:
+                    local.completed += 1
+                else:
+                    local.failed += 1
+                    if pool.error_handler is not None:
+                        pool._handle_error(task)
+                pool._call_hooks(pool.post_task_hooks, task)
+                n_tasks_left -= 1
+                if not n_tasks_left:
+                    break
+        finally:
+            stats.unregister(local)
+
+    def on_exit(self):
         self.pool.desc_spawned_thread()
-        logging.debug("[{0}] thread ends".format(self.ident))
 
 
 class DynamicThreadPool(object):
-    def __init__(self, max_worker_threads, max_idle_before_exit, max_capacity=0):
+    def __init__(self, max_worker_threads, max_idle_before_exit, max_capacity=0, low_watermark=None,
+                 prioritized=False, instrument=False, error_handler=None, max_tasks_per_worker=0):
+        if low_watermark is not None and not 0 <= low_watermark < max_capacity:
+            raise ValueError("low_watermark must be in [0, max_capacity), given({0})"
+                             .format(low_watermark))
         self.max_worker_threads = max_worker_threads
         self.max_idle_before_exit = max_idle_before_exit
+        self.max_capacity = max_capacity
+        self.low_watermark = max_capacity - 1 if low_watermark is None else low_watermark
+        self.error_handler = error_handler
+        self.max_tasks_per_worker = max_tasks_per_worker
         self.terminated = False
 
-        self.mutex = Mutex()
+        self.mutex = ProfiledMutex() if instrument else Mutex()
         self.n_idle_threads = 0
         self.n_spawned_threads = 0
 
-        self.pending_queue = Queue(max_capacity)
+        self.stats = PoolStats() if instrument else None
+        self.pre_task_hooks = []
+        self.post_task_hooks = []
+
+        self.prioritized = prioritized
+        self.pending_queue = (PriorityQueue if prioritized else Queue)(max_capacity)
         self.pending_queue_convar = ConVar(self.mutex)
 
+        #closed when the queue reaches max_capacity, reopened at low_watermark
+        self.accepting = True
+        self.not_full_convar = ConVar(self.mutex)
+
     def post_task(self, func, *args, **kwargs):
-        logging.debug("post task, func: {0} args: {1}, kwargs: {2}"
-                      .format(func, args, kwargs))
-        return self._post_task(PendingTask(func, *args, **kwargs))
+        """Post a task, block while the pool is full"""
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("post task, func: {0} args: {1}, kwargs: {2}"
+                          .format(func, args, kwargs))
+        task = PendingTask(func, *args, **kwargs)
+        self._post_task(task)
+        return task.future
+
+    def post_task_nowait(self, func, *args, **kwargs):
+        """Post a task, raise Full if the pool is full"""
+        return self.submit(func, args, kwargs, block=False)
+
+    def submit(self, func, args=(), kwargs=None, block=True, timeout=None, priority=0, deadline=None):
+        """
+        Post func(*args, **kwargs). When the pool is full, raise Full at once
+        if not `block`, or after `timeout` seconds if it is not None.
+
+        A prioritized pool runs tasks of lower `priority` first, FIFO within
+        a priority. A task not started within `deadline` seconds is dropped,
+        its future raises DeadlineExpired.
+        """
+        task = PendingTask(func, *args, **(kwargs or {}))
+        if priority:
+            if not self.prioritized:
+                raise ValueError("priority needs a pool created with prioritized=True")
+            task.priority = priority
+        if deadline is not None:
+            task.deadline = monotonic() + deadline
+        self._post_task(task, block, timeout)
+        return task.future
+
+    def post_many(self, calls, block=True, timeout=None):
+        """
+        Post a batch of calls, return their futures in order.
+        Each call is a callable, or a tuple (func, args) or (func, args, kwargs).
+        A bounded pool takes as many calls as fit at a time; if not `block`
+        or on `timeout`, only the futures of the calls taken are returned.
+        """
+        tasks = [PendingTask.from_call(call) for call in calls]
+        n_posted = self._post_tasks(tasks, block, timeout) if tasks else 0
+        return [task.future for task in tasks[:n_posted]]
+
+    def map(self, func, iterable, chunksize=1, timeout=None):
+        """
+        Like the builtin map(), but func runs in the pool, `chunksize` items
+        per task. The results are yielded in order, the first exception
+        raised by func is re-raised by the iterator.
+        """
+        if chunksize < 1:
+            raise ValueError("chunksize must be >= 1, given({0})".format(chunksize))
+
+        def run_chunk(chunk):
+            return [func(item) for item in chunk]
 
-    def _post_task(self, task):
+        it = iter(iterable)
+        chunks = iter(lambda: list(itertools.islice(it, chunksize)), [])
+        futures = self.post_many((run_chunk, (chunk,)) for chunk in chunks)
+
+        def results():
+            deadline = Deadline(timeout)
+            for future in futures:
+                for result in future.result(deadline.remaining()):
+                    yield result
+        return results()
+
+    def _post_task(self, task, block=True, timeout=None):
         assert self.n_spawned_threads >= 0
 
+        if self.stats is not None:
+            task.posted_at = monotonic()
         with self.mutex as lock:
+            if not self.accepting:
+                self._wait_accepting(block, timeout)
             self.pending_queue.put(task)
             if (self.n_idle_threads < self.pending_queue.size()
                     and self.n_spawned_threads < self.max_worker_threads):
                 Worker.spawn_daemonic_thread(self)
-                self.n_spawned_threads += 1
+                self._count_spawned(1)
             else:
                 self.pending_queue_convar.notify()
+            if self.max_capacity and self.pending_queue.size() >= self.max_capacity:
+                self.accepting = False
         return True
 
+    def _post_tasks(self, tasks, block=True, timeout=None):
+        """
+        Enqueue the tasks, spawn and wake workers, under one lock acquisition
+        as long as they fit. Return the number of tasks posted.
+        """
+        assert self.n_spawned_threads >= 0
+
+        deadline = Deadline(timeout)
+        n_posted = 0
+        if self.stats is not None:
+            for task in tasks:
+                task.posted_at = monotonic()
+        with self.mutex as lock:
+            while n_posted < len(tasks):
+                if not self.accepting:
+                    try:
+                        self._wait_accepting(block, deadline.remaining())
+                    except Full:
+                        break
+
+                n_batch = len(tasks) - n_posted
+                if self.max_capacity:
+                    n_batch = min(n_batch, self.max_capacity - self.pending_queue.size())
+                for task in tasks[n_posted:n_posted + n_batch]:
+                    self.pending_queue.put(task)
+                n_posted += n_batch
+
+                n_spawn = min(self.max_worker_threads - self.n_spawned_threads,
+                              self.pending_queue.size() - self.n_idle_threads)
+                for i in xrange(n_spawn):
+                    Worker.spawn_daemonic_thread(self)
+                self._count_spawned(max(n_spawn, 0))
+                self.pending_queue_convar.notify(min(n_batch, self.n_idle_threads))
+                if self.max_capacity and self.pending_queue.size() >= self.max_capacity:
+                    self.accepting = False
+        return n_posted
+
+    def _wait_accepting(self, block, timeout):
+        """Wait with the mutex held until the pool accepts tasks again"""
+        if not block:
+            raise Full
+        deadline = Deadline(timeout)
+        while not self.accepting:
+            if not deadline.wait(self.not_full_convar):
+                raise Full
+
     def wait_task(self):
         with self.mutex as lock:
-            left_time = self.max_idle_before_exit
-            end_time = time.time() + left_time
-            while self.pending_queue.empty() and left_time > 0 and not self.terminated:
-                self.n_idle_threads += 1
-                self.pending_queue_convar.wait(left_time)
-                self.n_idle_threads -= 1
-                left_time = end_time - time.time()
+            if self.pending_queue.empty():
+                deadline = Deadline(self.max_idle_before_exit)
+                while self.pending_queue.empty() and not self.terminated:
+                    self.n_idle_threads += 1
+                    waited = deadline.wait(self.pending_queue_convar)
+                    self.n_idle_threads -= 1
+                    if not waited:
+                        break
 
             try:
                 task = self.pending_queue.pop()
             except Empty:
                 return PendingTask()
-            else:
-                return task
+
+            if not self.accepting and self.pending_queue.size() <= self.low_watermark:
+                self.accepting = True
+                self.not_full_convar.notify(self.max_capacity - self.pending_queue.size())
+            return task
 
     def terminate(self):
         with self.mutex as lock:
             if self.terminated:
                 return
             self.terminated = True
-            self.pending_queue_convar.notifyAll()
+            self.pending_queue_convar.notify_all()
+
+    def cancel(self, future):
+        """
+        Cancel the task of `future` if it is still pending, its future raises
+        CancelledError. Return False if the task is running or done.
+        """
+        with self.mutex as lock:
+            task = self.pending_queue.remove_task_of(future)
+            if task is None:
+                return False
+            if not self.accepting and self.pending_queue.size() <= self.low_watermark:
+                self.accepting = True
+                self.not_full_convar.notify(self.max_capacity - self.pending_queue.size())
+        future._set(exception=CancelledError())
+        return True
 
     def desc_spawned_thread(self):
         with self.mutex as lock:
             self.n_spawned_threads -= 1
+            if self.stats is not None:
+                self.stats.threads_exited += 1
+            #a recycled or crashed worker leaves pending tasks behind
+            if (self.n_idle_threads < self.pending_queue.size()
+                    and self.n_spawned_threads < self.max_worker_threads):
+                Worker.spawn_daemonic_thread(self)
+                self._count_spawned(1)
+
+    def _handle_error(self, task):
+        try:
+            self.error_handler(task, task.future._exception)
+        except Exception:
+            logging.exception("exception calling error handler {0}".format(self.error_handler))
+
+    def _count_spawned(self, n):
+        """Called with the mutex held"""
+        self.n_spawned_threads += n
+        if self.stats is not None:
+            self.stats.threads_spawned += n
+
+    def add_pre_task_hook(self, hook):
+        """hook(task) is called by the worker before running a task, instrumented pools only"""
+        self._check_instrumented()
+        self.pre_task_hooks.append(hook)
+
+    def add_post_task_hook(self, hook):
+        """hook(task) is called by the worker after running a task, task.future is done"""
+        self._check_instrumented()
+        self.post_task_hooks.append(hook)
+
+    def _check_instrumented(self):
+        if self.stats is None:
+            raise ValueError("hooks need a pool created with instrument=True")
+
+    def _call_hooks(self, hooks, task):
+        for hook in hooks:
+            try:
+                hook(task)
+            except Exception:
+                logging.exception("exception calling hook {0}".format(hook))
+
+    def pending_size(self):
+        return self.pending_queue.size()
+
+    def snapshot(self):
+        """
+        The current gauges and, for instrumented pools, the counters and the
+        queue-wait/run-time histograms. Cheap enough to be scraped often.
+        """
+        snapshot = {'n_spawned_threads': self.n_spawned_threads,
+                    'n_idle_threads': self.n_idle_threads,
+                    'n_pending_tasks': self.pending_size()}
+        if self.stats is not None:
+            snapshot.update(self.stats.snapshot())
+            snapshot['lock_wait_time'] = self.mutex.wait_time
+            snapshot['lock_contended'] = self.mutex.n_contended
+        return snapshot
+
+
+class StealingWorker(Worker):
+    """A worker owning a deque of tasks, which other workers may steal from"""
+    def __init__(self, pool):
+        super(StealingWorker, self).__init__(pool)
+        self.tasks = deque()
+        self.retired = False
+
+    def next_task(self):
+        return self.pool.wait_task(self)
+
+    def on_exit(self):
+        #wait_task() retires idle workers, the others are recycled or crashed
+        if not self.retired:
+            self.pool._retire(self)
+
+
+class WorkStealingThreadPool(DynamicThreadPool):
+    """
+    DynamicThreadPool whose pending tasks live in per-worker deques.
+
+    deque.append/popleft/pop are atomic, so posting to a busy pool and taking
+    the next task never touch the mutex. The mutex guards spawning,
+    parking (n_idle_threads) and retiring of workers only.
+    `max_capacity` is not supported in this mode.
+    """
+    def __init__(self, max_worker_threads, max_idle_before_exit, max_capacity=0, instrument=False,
+                 error_handler=None, max_tasks_per_worker=0):
+        if max_capacity:
+            raise ValueError("max_capacity is not supported by WorkStealingThreadPool")
+        super(WorkStealingThreadPool, self).__init__(
+            max_worker_threads, max_idle_before_exit, instrument=instrument,
+            error_handler=error_handler, max_tasks_per_worker=max_tasks_per_worker)
+        #copy-on-write list of live workers, replaced under the mutex only
+        self.workers = []
+        self._next_worker = 0
+
+    def _post_task(self, task, block=True, timeout=None):
+        assert self.n_spawned_threads >= 0
+
+        if self.stats is not None:
+            task.posted_at = monotonic()
+        current = current_thread()
+        if (getattr(current, 'pool', None) is self and not current.retired
+                and (self.n_idle_threads or self.n_spawned_threads >= self.max_worker_threads)):
+            #posted by a task of this pool: keep it local, idle workers steal it.
+            #With none idle and room left a worker is spawned below, the task
+            #may wait for what it posted
+            current.tasks.append(task)
+            self._wake_idle()
+            return True
+
+        workers = self.workers
+        if workers and (self.n_idle_threads or self.n_spawned_threads >= self.max_worker_threads):
+            self._next_worker = index = (self._next_worker + 1) % len(workers)
+            worker = workers[index]
+            worker.tasks.append(task)
+            if worker.retired:
+                #the snapshot was stale, the worker may have drained its deque already
+                self._repost(worker)
+            self._wake_idle()
+            return True
+
+        with self.mutex as lock:
+            if (self.n_spawned_threads < self.max_worker_threads
+                    and (not self.n_idle_threads or not self.workers)):
+                worker = StealingWorker(self)
+                worker.tasks.append(task)
+                self.workers = self.workers + [worker]
+                self._count_spawned(1)
+                worker.start()
+            else:
+                self._next_worker = index = (self._next_worker + 1) % len(self.workers)
+                self.workers[index].tasks.append(task)
+                self.pending_queue_convar.notify()
+        return True
+
+    def _post_tasks(self, tasks, block=True, timeout=None):
+        if self.stats is not None:
+            for task in tasks:
+                task.posted_at = monotonic()
+        with self.mutex as lock:
+            #no more workers than tasks the idle ones leave
+            n_spawn = max(min(self.max_worker_threads - self.n_spawned_threads,
+                              len(tasks) - self.n_idle_threads), 0)
+            new_workers = [StealingWorker(self) for i in xrange(n_spawn)]
+            self.workers = workers = self.workers + new_workers
+            self._count_spawned(n_spawn)
+
+            #deal the tasks out round robin, one in n_workers each, new workers first
+            n_workers = len(workers)
+            offset = len(workers) - n_spawn
+            for i in xrange(n_workers):
+                worker = workers[(offset + i) % n_workers]
+                worker.tasks.extend(tasks[i::n_workers])
+            for worker in new_workers:
+                worker.start()
+            self.pending_queue_convar.notify(min(len(tasks), self.n_idle_threads))
+        return len(tasks)
+
+    def _wake_idle(self):
+        #n_idle_threads is read without the mutex; wait_task() rechecks the
+        #deques after publishing itself as idle, so no wakeup is lost
+        if self.n_idle_threads:
+            with self.mutex as lock:
+                self.pending_queue_convar.notify()
+
+    def pending_size(self):
+        return sum(len(worker.tasks) for worker in self.workers)
+
+    def cancel(self, future):
+        for worker in self.workers:
+            for task in list(worker.tasks):
+                if task.future is not future:
+                    continue
+                #deque.remove is atomic, a thief may have taken it meanwhile
+                try:
+                    worker.tasks.remove(task)
+                except ValueError:
+                    return False
+                future._set(exception=CancelledError())
+                return True
+        return False
+
+    def _repost(self, worker):
+        while True:
+            try:
+                task = worker.tasks.popleft()
+            except IndexError:
+                return
+            self._post_task(task)
+
+    def _find_task(self, worker):
+        try:
+            return worker.tasks.popleft()
+        except IndexError:
+            pass
+
+        workers = self.workers
+        n_workers = len(workers)
+        start = random.randrange(n_workers) if n_workers else 0
+        for i in xrange(n_workers):
+            victim = workers[(start + i) % n_workers]
+            if victim is worker:
+                continue
+            try:
+                return victim.tasks.pop()
+            except IndexError:
+                pass
+        return None
+
+    def wait_task(self, worker):
+        task = self._find_task(worker)
+        if task is not None:
+            return task
+
+        with self.mutex as lock:
+            deadline = Deadline(self.max_idle_before_exit)
+            while True:
+                task = self._find_task(worker)
+                if task is not None or deadline.expired() or self.terminated:
+                    break
+                self.n_idle_threads += 1
+                task = self._find_task(worker)
+                if task is None:
+                    deadline.wait(self.pending_queue_convar)
+                self.n_idle_threads -= 1
+                if task is not None:
+                    break
+
+        if task is None:
+            self._retire(worker)
+            return PendingTask()
+        return task
+
+    def _retire(self, worker):
+        with self.mutex as lock:
+            worker.retired = True
+            self.workers = [w for w in self.workers if w is not worker]
+            self.n_spawned_threads -= 1
+            if self.stats is not None:
+                self.stats.threads_exited += 1
+        #its own tasks, or a poster holding a stale snapshot may have pushed meanwhile
+        self._repost(worker)
+
+
+def benchmark(pool_class, n_tasks=200000, n_threads=32, **kwargs):
+    """Return tasks per second of `pool_class` running trivial tasks"""
+    import threading
+
+    done = threading.Event()
+    counter = itertools.count(1)
+
+    def task():
+        if next(counter) == n_tasks:
+            done.set()
+
+    pool = pool_class(n_threads, 1, **kwargs)
+    start = monotonic()
+    for i in xrange(n_tasks):
+        pool.post_task(task)
+    while not done.wait(1):
+        pass
+    elapsed = monotonic() - start
+    pool.terminate()
+    return n_tasks / elapsed
+
+
+def benchmark_submit(pool_class, batch, n_tasks=100000, n_threads=4):
+    """Return microseconds spent by the caller to submit one trivial task"""
+    pool = pool_class(n_threads, 1)
+    start = monotonic()
+    if batch:
+        pool.post_many([int] * n_tasks)
+    else:
+        for i in xrange(n_tasks):
+            pool.post_task(int)
+    elapsed = monotonic() - start
+    pool.terminate()
+    return elapsed * 1e6 / n_tasks
+
+
+def benchmark_queue(queue_class, n_tasks=200000):
+    """Return microseconds to put and pop one task of the default priority"""
+    queue = queue_class()
+    tasks = [PendingTask(int) for i in xrange(n_tasks)]
+    start = monotonic()
+    for task in tasks:
+        queue.put(task)
+    while not queue.empty():
+        queue.pop()
+    return (monotonic() - start) * 1e6 / n_tasks
 
 
 if __name__ == "__main__":
-    import random
+    import sys
+
+    if sys.argv[1:] == ['bench']:
+        for pool_class in (DynamicThreadPool, WorkStealingThreadPool):
+            print('{0}: {1:.0f} tasks/s'.format(pool_class.__name__, benchmark(pool_class)))
+            print('{0}: post_task {1:.2f}us/task, post_many {2:.2f}us/task'.format(
+                pool_class.__name__,
+                benchmark_submit(pool_class, False), benchmark_submit(pool_class, True)))
+        for queue_class in (Queue, PriorityQueue):
+            print('{0}: put+pop {1:.2f}us/task'.format(queue_class.__name__, benchmark_queue(queue_class)))
+        print('DynamicThreadPool(prioritized=True): {0:.0f} tasks/s'.format(
+            benchmark(DynamicThreadPool, prioritized=True)))
+        print('DynamicThreadPool(instrument=True): {0:.0f} tasks/s'.format(
+            benchmark(DynamicThreadPool, instrument=True)))
+        #leave time for the daemonic workers to exit before the interpreter does
+        time.sleep(1.5)
+        sys.exit(0)
 
 
     def func(*args, **kwargs):
-        print '[{0}] starts job'.format(args[0])
+        print('[{0}] starts job'.format(args[0]))
         time.sleep(random.randint(1, 3)/10.0)
-        print '[{0}] ends job'.format(args[0])
+        print('[{0}] ends job'.format(args[0]))
 
     pool = DynamicThreadPool(4, 10)
     for i in range(10):
@@ -194,3 +1120,204 @@ if __name__ == "__main__":
     #leave time for the pool existed, before all global varibles become None
     time.sleep(0.5)
 
+    import threading
+    gate = threading.Event()
+    pool = DynamicThreadPool(1, 1, max_capacity=4, low_watermark=1)
+    pool.post_task(gate.wait)
+    time.sleep(0.1)
+    futures = pool.post_many([int] * 10, timeout=0.1)
+    assert len(futures) == 4
+    try:
+        pool.post_task_nowait(int)
+    except Full:
+        pass
+    else:
+        assert False, "Full expected"
+    try:
+        pool.submit(int, timeout=0.05)
+    except Full:
+        pass
+    else:
+        assert False, "Full expected"
+    threading.Timer(0.2, gate.set).start()
+    start = monotonic()
+    assert pool.post_task(abs, -1).result(5) == 1
+    assert monotonic() - start >= 0.15
+    assert all(f.result(5) == 0 for f in futures)
+    pool.terminate()
+
+    gate = threading.Event()
+    order = []
+    pool = DynamicThreadPool(1, 1, prioritized=True)
+    pool.post_task(gate.wait)
+    time.sleep(0.1)
+    futures = [pool.submit(order.append, (i,), priority=p)
+               for i, p in enumerate([5, 1, 5, 0, 1, 5])]
+    expired = pool.submit(order.append, ('late',), deadline=0.05)
+    time.sleep(0.1)
+    gate.set()
+    wait(futures, 5)
+    assert order == [3, 1, 4, 0, 2, 5]
+    assert isinstance(expired.exception(5), DeadlineExpired)
+    try:
+        DynamicThreadPool(1, 1).submit(int, priority=1)
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError expected"
+    pool.terminate()
+
+    results = []
+    finished = threading.Event()
+    def collect(i):
+        results.append(i)
+        if len(results) == 1000:
+            finished.set()
+
+    pool = WorkStealingThreadPool(8, 0.2)
+    for i in range(1000):
+        pool.post_task(collect, i)
+    finished.wait(10)
+    assert sorted(results) == list(range(1000))
+    time.sleep(0.5)
+    assert pool.n_spawned_threads == 0 and pool.workers == []
+    pool.terminate()
+
+    def square(i):
+        time.sleep(random.randint(0, 3) / 100.0)
+        if i == 3:
+            raise KeyError(i)
+        return i * i
+
+    for pool in (DynamicThreadPool(4, 1), WorkStealingThreadPool(4, 1)):
+        futures = [pool.post_task(square, i) for i in range(10)]
+        assert futures[0].result(5) == 0
+        assert isinstance(futures[3].exception(5), KeyError)
+        called = []
+        futures[9].add_done_callback(called.append)
+        assert sorted(f.result() for f in as_completed(futures[4:], 5)) == [i * i for i in range(4, 10)]
+        assert called == [futures[9]]
+        done, not_done = wait(futures, 5)
+        assert len(done) == 10 and not not_done
+
+        slow = pool.post_task(time.sleep, 0.3)
+        try:
+            slow.result(0.01)
+        except TimeoutError:
+            pass
+        else:
+            assert False, "TimeoutError expected"
+        done, not_done = wait([slow, futures[3]], 5, FIRST_EXCEPTION)
+        assert futures[3] in done
+
+        futures = pool.post_many([int, (square, (2,)), (dict, (), {'a': 1})])
+        assert [f.result(5) for f in futures] == [0, 4, {'a': 1}]
+        assert list(pool.map(abs, range(-100, 0), 7)) == list(range(100, 0, -1))
+        try:
+            list(pool.map(square, range(5), 2))
+        except KeyError:
+            pass
+        else:
+            assert False, "KeyError expected"
+        pool.terminate()
+    time.sleep(0.5)
+
+    for pool in (DynamicThreadPool(1, 1), DynamicThreadPool(1, 1, prioritized=True),
+                 WorkStealingThreadPool(1, 1)):
+        gate = threading.Event()
+        running = pool.post_task(gate.wait)
+        time.sleep(0.1)
+        pending = [pool.post_task(abs, -i) for i in range(3)]
+        assert not pool.cancel(running)
+        assert pool.cancel(pending[1]) and pending[1].cancelled()
+        assert not pool.cancel(pending[1])
+        gate.set()
+        assert pending[2].result(5) == 2 and not pending[2].cancelled()
+        assert isinstance(pending[1].exception(), CancelledError)
+        pool.terminate()
+
+    class WorkerKill(BaseException):
+        """Escapes the exception barrier of PendingTask"""
+
+    def faulty(i):
+        if i % 7 == 0:
+            raise ValueError(i)
+        if i % 101 == 0:
+            raise WorkerKill(i)
+        return i
+
+    import sys
+    stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+    for pool_class in (DynamicThreadPool, WorkStealingThreadPool):
+        for instrument in (False, True):
+            errors = []
+            pool = pool_class(8, 0.2, instrument=instrument, max_tasks_per_worker=5,
+                              error_handler=lambda task, exc: errors.append(exc))
+            futures = []
+            for i in range(1, 2000):
+                futures.append(pool.post_task(faulty, i))
+                assert 0 <= pool.n_spawned_threads <= 8
+            done, not_done = wait(futures, 10)
+            assert not not_done
+            assert len(errors) == len([i for i in range(1, 2000) if i % 7 == 0])
+            time.sleep(0.5)
+            assert pool.n_spawned_threads == 0 and pool.n_idle_threads == 0
+            assert pool.post_task(faulty, 1).result(5) == 1
+            pool.terminate()
+    sys.stderr = stderr
+
+    for pool in (DynamicThreadPool(4, 0.2, instrument=True), WorkStealingThreadPool(4, 0.2, instrument=True)):
+        before, after = [], []
+        pool.add_pre_task_hook(before.append)
+        pool.add_post_task_hook(lambda task: after.append(task.future.done()))
+        futures = pool.post_many([(square, (i % 5,)) for i in range(100)])
+        wait(futures, 5)
+        time.sleep(0.5)
+        stats = pool.snapshot()
+        assert stats['tasks_completed'] == 80 and stats['tasks_failed'] == 20
+        assert stats['run_time']['count'] == stats['queue_wait']['count'] == 100
+        assert stats['threads_spawned'] == stats['threads_exited'] > 0
+        assert stats['n_spawned_threads'] == 0 and stats['n_pending_tasks'] == 0
+        assert len(before) == 100 and all(after) and len(after) == 100
+        pool.terminate()
+    #a task waiting for its subtask gets a new worker for it, as with DynamicThreadPool
+    for pool in (DynamicThreadPool(4, 1), WorkStealingThreadPool(4, 1)):
+        assert pool.submit(lambda: pool.submit(abs, (-5,)).result(2)).result(5) == 5
+        pool.terminate()
+    #one task spawns one worker, not max_worker_threads
+    pool = WorkStealingThreadPool(32, 0.2)
+    assert pool.post_many([(int, ())])[0].result(5) == 0
+    assert pool.n_spawned_threads == 1 and len(pool.workers) == 1
+    pool.terminate()
+    try:
+        DynamicThreadPool(1, 1).add_pre_task_hook(len)
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError expected"
+
+    #the wall clock stepping an hour at each reading neither expires idle
+    #workers and deadlines early nor stretches timeouts. Forward, it also wakes
+    #the condition waits of python2 early, its threading reads its own _time;
+    #backward they would never wake
+    real_time, real_threading_time = time.time, getattr(threading, '_time', None)
+    try:
+        for step in (3600, -3600):
+            readings = itertools.count(1)
+            time.time = lambda: real_time() + step * next(readings)
+            if real_threading_time is not None:
+                threading._time = time.time if step > 0 else real_threading_time
+            for pool in (DynamicThreadPool(2, 0.3), WorkStealingThreadPool(2, 0.3)):
+                assert pool.submit(abs, (-1,), deadline=5).result(5) == 1
+                time.sleep(0.1)
+                assert pool.n_spawned_threads == 1
+                start = monotonic()
+                done, not_done = wait([pool.submit(time.sleep, (0.5,))], 0.05)
+                assert not done and 0.05 <= monotonic() - start < 0.4
+                wait(not_done, 5)
+                pool.terminate()
+    finally:
+        time.time = real_time
+        if real_threading_time is not None:
+            threading._time = real_threading_time
+    time.sleep(0.5)
@@ -5,37 +5,494 @@
 """
 Looper is a loop timer that runs the given `func` each `interval` seconds.
 It is inspired by threading.Timer().
+
+By default Looper waits `interval` seconds between the end of a run and the
+start of the next, so each period is interval plus the run time of `func`.
+With `fixed_rate`, the n-th run is due `n * interval` seconds after a start
+time taken on the monotonic clock: the run time does not add up and the runs
+stay aligned to the interval, e.g. to flush metrics on aggregation windows.
+    looper = Looper(1, flush, fixed_rate=True, missed=COALESCE)
+
+When a run overruns one or more due times, `missed` tells what to do with them:
+    SKIP      drop them, the next run waits for the next due time
+    CATCHUP   run them all back to back without waiting
+    COALESCE  run once without waiting for all of them
+
+snapshot() reports the runs, the overruns and the missed due times,
+and how late the runs started.
+
+Loopers are not threads: a TimerService runs any number of them, and one-shot
+timers, from a single thread sleeping until the earliest due time of a heap.
+Loopers share the default service unless given one. A service given a
+DynamicThreadPool only keeps time and posts the due calls to the pool, so a
+slow func does not delay the other timers:
+    service = TimerService(pool=DynamicThreadPool(8, 10))
+    Looper(5, poll, service=service).start()
+    timer = service.call_later(30, expire, session)
+    timer.cancel()
+
+A looper never runs concurrently with itself, its next due time is computed
+once a run ends. The thread of a service exits when it has no timer left, and
+like the thread of a Looper used to, keeps the process alive until then.
 """
+from __future__ import print_function
 
+import heapq
+import logging
+import itertools
 import threading
 
+from timetools import monotonic
+from locktools import guard
 
-class Looper(threading.Thread):
-    def __init__(self, interval, func, args=None, kwargs=None):
-        threading.Thread.__init__(self)
-        self._interval = float(interval)
+try:
+    xrange
+except NameError:
+    xrange = range
+
+
+SKIP = 'SKIP'
+CATCHUP = 'CATCHUP'
+COALESCE = 'COALESCE'
+
+
+class TimerService(object):
+    def __init__(self, pool=None):
+        self.pool = pool
+        #(due, seq, timer), cancelled timers are left in place until popped or purged
+        self.heap = []
+        self.seq = itertools.count()
+        self.mutex = threading.Lock()
+        self.convar = threading.Condition(self.mutex)
+        self.thread = None
+        self.n_scheduled = 0
+        self.n_cancelled = 0
+        self.n_firing = 0
+        #times the thread woke up, for the curious
+        self.n_wakeups = 0
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """Run func(*args, **kwargs) once in `delay` seconds, return the Timer to cancel it"""
+        timer = Timer(func, args, kwargs, self)
+        self.schedule(timer, monotonic() + delay)
+        return timer
+
+    def schedule(self, timer, due):
+        with guard(self.mutex):
+            if timer.cancelled or timer.scheduled:
+                raise ValueError("timer cancelled or scheduled already")
+            timer.due = due
+            timer.scheduled = True
+            heapq.heappush(self.heap, (due, next(self.seq), timer))
+            self.n_scheduled += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='TimerService')
+                self.thread.start()
+            elif self.heap[0][2] is timer:
+                #earlier than the thread sleeps for
+                self.convar.notify()
+
+    def cancel(self, timer):
+        with guard(self.mutex):
+            timer.cancelled = True
+            if not timer.scheduled:
+                return
+            timer.scheduled = False
+            self.n_scheduled -= 1
+            self.n_cancelled += 1
+            if self.n_cancelled > 64 and self.n_cancelled > len(self.heap) // 2:
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.n_cancelled = 0
+            if self.n_scheduled == 0:
+                self.convar.notify()
+
+    def pending_size(self):
+        return self.n_scheduled
+
+    def _run(self):
+        while True:
+            with guard(self.mutex):
+                due_timers = self._wait_due()
+                if due_timers is None:
+                    return
+            for timer in due_timers:
+                if self.pool is None:
+                    self._fire(timer)
+                else:
+                    self.pool.post_task(self._fire, timer)
+
+    def _wait_due(self):
+        """Pop the due timers with the mutex held, None once there is nothing left to wait for"""
+        while True:
+            if self.n_scheduled == 0 and self.n_firing == 0:
+                del self.heap[:]
+                self.n_cancelled = 0
+                self.thread = None
+                return None
+            heap = self.heap
+            now = monotonic()
+            due_timers = []
+            while heap and heap[0][0] <= now:
+                due, seq, timer = heapq.heappop(heap)
+                if timer.cancelled:
+                    self.n_cancelled -= 1
+                    continue
+                timer.scheduled = False
+                due_timers.append(timer)
+            if due_timers:
+                self.n_scheduled -= len(due_timers)
+                self.n_firing += len(due_timers)
+                return due_timers
+            self.convar.wait(heap[0][0] - now if heap else None)
+            self.n_wakeups += 1
+
+    def _fire(self, timer):
+        try:
+            timer.fire()
+        except Exception:
+            logging.exception("timer {0} failed".format(timer))
+        finally:
+            with guard(self.mutex):
+                self.n_firing -= 1
+                if self.n_firing == 0 and self.n_scheduled == 0:
+                    self.convar.notify()
+
+
+_default_service = None
+_default_service_mutex = threading.Lock()
+#guards the run state of all loopers, one lock each would weigh as much as a looper
+_looper_mutex = threading.Lock()
+
+
+def default_service():
+    """The TimerService of the timers created without one"""
+    global _default_service
+    with guard(_default_service_mutex):
+        if _default_service is None:
+            _default_service = TimerService()
+        return _default_service
+
+
+class Timer(object):
+    """A call to run once by a TimerService, see TimerService.call_later()"""
+    __slots__ = ('_func', '_args', '_kwargs', '_service', 'due', 'scheduled', 'cancelled')
+
+    def __init__(self, func, args=None, kwargs=None, service=None):
         self._func = func
-        self._args = args or []
+        self._args = args or ()
         self._kwargs = kwargs or {}
+        self._service = service or default_service()
+        #guarded by the mutex of the service
+        self.due = None
+        self.scheduled = False
+        self.cancelled = False
+
+    def cancel(self):
+        self._service.cancel(self)
+
+    def fire(self):
+        self._func(*self._args, **self._kwargs)
+
+
+class Looper(Timer):
+    __slots__ = ('_interval', '_fixed_rate', '_missed', '_started', '_running', '_stopped',
+                 '_stopped_event', '_anchor', '_tick', 'n_runs', 'n_overruns', 'n_missed',
+                 'max_lateness', 'total_lateness', 'max_run_time')
+
+    def __init__(self, interval, func, args=None, kwargs=None, fixed_rate=False, missed=SKIP,
+                 service=None):
+        super(Looper, self).__init__(func, args, kwargs, service)
+        if missed not in (SKIP, CATCHUP, COALESCE):
+            raise ValueError("missed must be SKIP, CATCHUP or COALESCE, given({0})".format(missed))
+        self._interval = float(interval)
+        self._fixed_rate = fixed_rate
+        self._missed = missed
+        #guarded by _looper_mutex
+        self._started = False
+        self._running = False
+        self._stopped = False
+        #created by join() only
+        self._stopped_event = None
+        self._anchor = None
+        self._tick = 1
+
+        #only written by the run of the looper
+        self.n_runs = 0
+        self.n_overruns = 0
+        self.n_missed = 0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.max_run_time = 0.0
+
+    def start(self):
+        with guard(_looper_mutex):
+            if self._started:
+                raise RuntimeError("looper can only be started once")
+            self._started = True
+            self._anchor = monotonic()
+            self._service.schedule(self, self._anchor + self._interval)
+
+    def terminate(self):
+        with guard(_looper_mutex):
+            self._service.cancel(self)
+            if not self._running:
+                self._stop()
+
+    cancel = terminate
+
+    def _stop(self):
+        self._stopped = True
+        if self._stopped_event is not None:
+            self._stopped_event.set()
+
+    def join(self, timeout=None):
+        """Wait until terminated and done with its last run"""
+        if not self._started:
+            raise RuntimeError("cannot join looper before it is started")
+        with guard(_looper_mutex):
+            if self._stopped:
+                return
+            if self._stopped_event is None:
+                self._stopped_event = threading.Event()
+            event = self._stopped_event
+        event.wait(timeout)
+
+    def is_alive(self):
+        return self._started and not self._stopped
+
+    def snapshot(self):
+        return {'n_runs': self.n_runs,
+                'n_overruns': self.n_overruns,
+                'n_missed': self.n_missed,
+                'max_lateness': self.max_lateness,
+                'mean_lateness': self.total_lateness / self.n_runs if self.n_runs else 0.0,
+                'max_run_time': self.max_run_time}
+
+    def fire(self):
+        with guard(_looper_mutex):
+            if self.cancelled:
+                return
+            self._running = True
+        due = self.due
+        start = monotonic()
+        try:
+            self._func(*self._args, **self._kwargs)
+        except Exception:
+            #stops, as a Looper did when its thread died
+            self._service.cancel(self)
+            raise
+        finally:
+            end = monotonic()
+            self._count_run(start - due if self._fixed_rate else 0.0, end - start)
+            with guard(_looper_mutex):
+                self._running = False
+                if self.cancelled:
+                    self._stop()
+                else:
+                    self._service.schedule(self, self._next_due(start, end))
+
+    def _count_run(self, lateness, run_time):
+        self.n_runs += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.max_run_time = max(self.max_run_time, run_time)
+
+    def _next_due(self, start, end):
+        if not self._fixed_rate:
+            return end + self._interval
+
+        interval, anchor, tick = self._interval, self._anchor, self._tick
+        #the last tick due by now, later than `tick` once behind schedule,
+        #and only an overrun if it went by during this run, not before
+        last_due = int((end - anchor) // interval)
+        if last_due <= tick:
+            tick += 1
+        else:
+            if last_due > int((start - anchor) // interval):
+                self.n_overruns += 1
+            if self._missed == SKIP:
+                self.n_missed += last_due - tick
+                tick = last_due + 1
+            elif self._missed == COALESCE:
+                self.n_missed += last_due - tick - 1
+                tick = last_due
+            else:
+                tick += 1
+        self._tick = tick
+        return anchor + tick * interval
+
+
+def _rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+class _ThreadLooper(threading.Thread):
+    """A looper owning its thread, as Looper used to be, for the benchmark"""
+    def __init__(self, interval, func):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._interval = interval
+        self._func = func
         self._finished = threading.Event()
 
     def terminate(self):
         self._finished.set()
 
     def run(self):
-        while not self._finished.is_set():
-            if self._finished.wait(self._interval):
-                break
-            self._func(*self._args, **self._kwargs)
+        while not self._finished.wait(self._interval):
+            self._func()
+
+
+def benchmark(n_timers=10000, duration=3.0, threads=False):
+    """
+    Return the RSS growth in KiB, the context switches and the runs of
+    `n_timers` loopers of 1s running for `duration` seconds, on one
+    TimerService or on a thread each
+    """
+    import time
+    import resource
+
+    runs = []
+    def func():
+        runs.append(None)
+
+    rss = _rss_kb()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    service = TimerService()
+    if threads:
+        loopers = [_ThreadLooper(1.0, func) for i in xrange(n_timers)]
+    else:
+        loopers = [Looper(1.0, func, service=service) for i in xrange(n_timers)]
+    for looper in loopers:
+        looper.start()
+    rss = _rss_kb() - rss
+    del runs[:]
+    time.sleep(duration)
+    for looper in loopers:
+        looper.terminate()
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    n_switches = (usage_after.ru_nvcsw + usage_after.ru_nivcsw
+                  - usage.ru_nvcsw - usage.ru_nivcsw)
+    return rss, n_switches, len(runs)
 
 
 if __name__ == '__main__':
+    import sys
     import time
+
+    if sys.argv[1:] == ['bench']:
+        #10k threads take minutes to merely start on python2
+        for n_timers, threads in ((10000, False), (1000, True)):
+            rss, n_switches, n_runs = benchmark(n_timers, threads=threads)
+            print('{0} loopers of 1s on {1}: +{2} KiB RSS, {3} context switches, {4} runs in 3s'
+                  .format(n_timers, 'a thread each' if threads else 'one TimerService',
+                          rss, n_switches, n_runs))
+        time.sleep(1.5)
+        sys.exit(0)
+
     def func():
-        print 1
+        print(1)
 
     loop = Looper(0.1, func)
     loop.start()
     time.sleep(1)
-    print 'terminate'
+    print('terminate')
     loop.terminate()
+    loop.join()
+
+    #the runs of a fixed rate looper do not drift by their run time
+    starts = []
+    def slow():
+        starts.append(monotonic())
+        time.sleep(0.02)
+    for fixed_rate in (False, True):
+        del starts[:]
+        loop = Looper(0.05, slow, fixed_rate=fixed_rate)
+        loop.start()
+        while len(starts) < 10:
+            time.sleep(0.01)
+        loop.terminate()
+        loop.join()
+        if fixed_rate:
+            assert starts[9] - starts[0] < 9 * 0.05 + 0.03, starts[9] - starts[0]
+        else:
+            assert starts[9] - starts[0] >= 9 * (0.05 + 0.02)
+
+    #the first run overruns the 2nd and 3rd due times, at 0.2s and 0.3s,
+    #the 4th is due at 0.4s
+    for missed, n_early_runs, n_missed in ((SKIP, 1, 2), (COALESCE, 2, 1), (CATCHUP, 3, 0)):
+        starts = []
+        def overrun():
+            starts.append(monotonic())
+            if len(starts) == 1:
+                time.sleep(0.25)
+        begin = monotonic()
+        loop = Looper(0.1, overrun, fixed_rate=True, missed=missed)
+        loop.start()
+        while len(starts) < 5:
+            time.sleep(0.01)
+        loop.terminate()
+        loop.join()
+        assert len([t for t in starts if t - begin < 0.39]) == n_early_runs, (missed, starts)
+        stats = loop.snapshot()
+        assert stats['n_overruns'] == 1 and stats['n_missed'] == n_missed, (missed, stats)
+        assert stats['n_runs'] >= 5 and stats['max_run_time'] >= 0.25
+        #skipped due times are not late runs
+        if missed == SKIP:
+            assert stats['max_lateness'] < 0.05
+        else:
+            assert stats['max_lateness'] >= 0.05
+
+    #one thread runs timers in due time order, a cancelled one never runs
+    service = TimerService()
+    fired = []
+    for delay in (0.03, 0.01, 0.02):
+        service.call_later(delay, fired.append, delay)
+    service.call_later(0.015, fired.append, 'cancelled').cancel()
+    loopers = [Looper(0.01, fired.append, ('loop',), service=service) for i in range(100)]
+    for looper in loopers:
+        looper.start()
+    time.sleep(0.1)
+    for looper in loopers:
+        looper.terminate()
+    for looper in loopers:
+        looper.join(1)
+        assert not looper.is_alive()
+    assert [f for f in fired if f != 'loop'] == [0.01, 0.02, 0.03]
+    assert fired.count('loop') >= 500
+    time.sleep(0.05)
+    assert service.thread is None and service.pending_size() == 0 and not service.heap
+
+    #a failing looper stops, the others go on
+    def fail():
+        raise ValueError
+    logging.disable(logging.CRITICAL)
+    failing = Looper(0.01, fail, service=service)
+    counting = Looper(0.01, fired.append, (1,), service=service)
+    failing.start()
+    counting.start()
+    failing.join(1)
+    assert not failing.is_alive() and failing.n_runs == 1
+    del fired[:]
+    time.sleep(0.05)
+    assert len(fired) >= 3
+    counting.terminate()
+    logging.disable(logging.NOTSET)
+
+    #with a pool, the service only keeps time
+    from DynamicThreadPool import DynamicThreadPool
+    pool = DynamicThreadPool(4, 1)
+    service = TimerService(pool)
+    threads = set()
+    looper = Looper(0.01, lambda: threads.add(threading.current_thread()), service=service)
+    looper.start()
+    time.sleep(0.1)
+    looper.terminate()
+    looper.join(1)
+    assert threads and service.thread not in threads and looper.n_runs >= 5
+    pool.terminate()
+    time.sleep(0.5)
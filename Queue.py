@@ -7,8 +7,18 @@ __version__ = "0.0.1"
 '''multi-thread queue likes Queue.queue'''
 
 
+import heapq as _heapq
+import itertools as _itertools
 import threading as _threading
-import time as _time
+
+from collections import deque as _deque
+
+from timetools import monotonic as _monotonic, Deadline as _Deadline
+
+try:
+    xrange
+except NameError:
+    xrange = range
 
 
 class Full(Exception):
@@ -21,21 +31,27 @@ class Empty(Exception):
 class Queue(object):
     def __init__(self, maxsize=0):
         self.maxsize = maxsize
-        self.queue = []
+        self.queue = _deque()
 
         #one lock with three condition-waiting queue
         self.mutex = _threading.Lock() 
         self.not_full = _threading.Condition(self.mutex)
         self.not_empty = _threading.Condition(self.mutex)
+        #threads waiting on not_full/not_empty, nobody to notify is the common case
+        self.n_waiting_putters = 0
+        self.n_waiting_getters = 0
 
         self.all_tasks_done = _threading.Condition(self.mutex)
         self.un_finished_tasks = 0
     
     def clear(self):
         with self.mutex as lock:
-            self.queue = []
+            self._clear()
             self.not_full.notify_all()
 
+    def _clear(self):
+        self.queue.clear()
+
     def task_done(self):
         with self.all_tasks_done as condition:
             unfinished = self.un_finished_tasks - 1
@@ -50,80 +66,412 @@ class Queue(object):
             while self.un_finished_tasks > 0:
                 self.all_tasks_done.wait()
             
+    #qsize/full/empty are snapshots, stale as soon as they return even under the lock,
+    #so they do not take it: len() of the deque is atomic
     def qsize(self):
-        with self.mutex as lock:
-            return self._qsize()
+        return self._qsize()
 
-    def _qsize(self): #there must be a way to get the size of self.queue without lock
+    def _qsize(self):
         return len(self.queue)
 
     def full(self):
-        with self.mutex as lock:
-            return self.qsize() >= self.maxsize if self.maxsize > 0 else False
+        return self._qsize() >= self.maxsize if self.maxsize > 0 else False
 
     def empty(self):
-        with self.mutex as lock:
-            return self.qsize() <= 0
+        return self._qsize() <= 0
 
     def _put(self, ele):
         self.queue.append(ele)
         self.un_finished_tasks += 1
 
     def put(self, ele, block=True, timeout=None):
-        with self.not_full as condition:
+        #the lock's own context manager, Condition.__enter__ is a python call on 2.x
+        with self.mutex as lock:
             if self.maxsize > 0:
                 if not block:
-                    if self._qsize() >= self.maxsize: #can not use self.qssize(), which will relock the self.mutex leading to deadlock
+                    if self._qsize() >= self.maxsize:
                         raise Full
-                elif timeout is None:
+                elif self._qsize() >= self.maxsize:
+                    deadline = _Deadline(timeout)
                     while self._qsize() >= self.maxsize:
-                        self.not_full.wait()
-                elif timeout < 0:
-                    raise ValueError("timeout must be >0, given(%d)" % timeout)
-                else:
-                    end = _time.time() + timeout
-                    while self._qsize() >= self.maxsize:
-                        remaining = end - _time.time()
-                        if remaining < 0.0:
-                            raise Full
-                        self.not_full.wait(remaining)
+                        self.n_waiting_putters += 1
+                        try:
+                            if not deadline.wait(self.not_full):
+                                raise Full
+                        finally:
+                            self.n_waiting_putters -= 1
 
             self._put(ele)
-            self.not_empty.notify()
+            if self.n_waiting_getters:
+                self.not_empty.notify()
 
     def put_nowait(self, ele):
         self.put(ele, False)
 
+    def put_many(self, eles, block=True, timeout=None):
+        """
+        Put the elements under one lock acquisition as long as they fit,
+        waking as many getters as elements were put. A bounded queue takes as
+        many as fit and waits for room for the rest, unless not `block` or
+        until `timeout`. Return the number of elements put.
+        """
+        eles = list(eles)
+        n_put = 0
+        deadline = _Deadline(timeout)
+        with self.mutex as lock:
+            while True:
+                n_fit = len(eles) - n_put
+                if self.maxsize > 0:
+                    n_fit = min(n_fit, self.maxsize - self._qsize())
+                if n_fit > 0:
+                    self._put_many(eles[n_put:n_put + n_fit])
+                    n_put += n_fit
+                    if self.n_waiting_getters:
+                        self.not_empty.notify(min(n_fit, self.n_waiting_getters))
+                if n_put == len(eles) or not block:
+                    return n_put
+
+                self.n_waiting_putters += 1
+                try:
+                    if not deadline.wait(self.not_full):
+                        return n_put
+                finally:
+                    self.n_waiting_putters -= 1
+
+    def _put_many(self, eles):
+        for ele in eles:
+            self._put(ele)
+
     def _get(self):
-        return self.queue.pop(0)
+        return self.queue.popleft()
 
     def get(self, block=True, timeout=None):
-        with self.not_empty as condition:
+        with self.mutex as lock:
             if not block:
                 if self._qsize() == 0:
                     raise Empty
-            elif timeout is None:
+            elif self._qsize() == 0:
+                deadline = _Deadline(timeout)
                 while self._qsize() == 0:
-                    self.not_empty.wait()
-            elif timeout < 0:
-                raise ValueError("timeout must be > 0, given(%d)" % timeout)
-            else:
-                end = _time.time() + timeout
-                while self._qsize() == 0:
-                    remaining = end  - _time.time()
-                    if remaining < 0.0:
-                        raise Empty
-                    self.not_empty.wait(remaining)
+                    self.n_waiting_getters += 1
+                    try:
+                        if not deadline.wait(self.not_empty):
+                            raise Empty
+                    finally:
+                        self.n_waiting_getters -= 1
             ele = self._get()
-            self.not_full.notify()
+            if self.n_waiting_putters:
+                self.not_full.notify()
             return  ele 
 
     def get_notwait(self):
         self.get(False)
 
+    def get_many(self, max_eles, block=True, timeout=None):
+        """
+        Wait like get() for at least one element, then take up to `max_eles`
+        under the same lock acquisition, waking as many putters as freed slots.
+        """
+        if max_eles < 1:
+            raise ValueError("max_eles must be >= 1, given(%d)" % max_eles)
+        with self.mutex as lock:
+            if not block:
+                if self._qsize() == 0:
+                    raise Empty
+            elif self._qsize() == 0:
+                deadline = _Deadline(timeout)
+                while self._qsize() == 0:
+                    self.n_waiting_getters += 1
+                    try:
+                        if not deadline.wait(self.not_empty):
+                            raise Empty
+                    finally:
+                        self.n_waiting_getters -= 1
+            eles = self._get_many(min(max_eles, self._qsize()))
+            if self.n_waiting_putters:
+                self.not_full.notify(min(len(eles), self.n_waiting_putters))
+            return eles
+
+    def _get_many(self, n):
+        return [self._get() for i in xrange(n)]
+
+
+class LifoQueue(Queue):
+    """Queue getting the most recently put element first"""
+    def _get(self):
+        return self.queue.pop()
+
+
+class PriorityQueue(Queue):
+    """Queue getting the lowest element first, put (priority, data) tuples"""
+    def __init__(self, maxsize=0):
+        super(PriorityQueue, self).__init__(maxsize)
+        self.queue = []
+
+    def _clear(self):
+        del self.queue[:]
+
+    def _put(self, ele):
+        _heapq.heappush(self.queue, ele)
+        self.un_finished_tasks += 1
+
+    def _get(self):
+        return _heapq.heappop(self.queue)
+
+
+class DelayQueue(PriorityQueue):
+    """
+    Queue whose elements become visible `delay` seconds after put, in ready time
+    order, e.g. retries with backoff:
+        q.put(job, delay=2 ** n_retries)
+    A getter sleeps until the earliest ready time, or until a put brings it
+    forward, instead of polling. qsize()/full()/empty() count the elements
+    not ready yet.
+    """
+    def __init__(self, maxsize=0):
+        super(DelayQueue, self).__init__(maxsize)
+        #tie breaker, elements of the same ready time are got in put order
+        self.seq = _itertools.count()
+
+    def put(self, ele, block=True, timeout=None, delay=0):
+        super(DelayQueue, self).put((_monotonic() + delay, ele), block, timeout)
+
+    def put_nowait(self, ele, delay=0):
+        self.put(ele, False, delay=delay)
+
+    def put_many(self, eles, block=True, timeout=None, delay=0):
+        ready_at = _monotonic() + delay
+        return super(DelayQueue, self).put_many([(ready_at, ele) for ele in eles],
+                                                block, timeout)
+
+    def _put(self, ele):
+        ready_at, ele = ele
+        _heapq.heappush(self.queue, (ready_at, next(self.seq), ele))
+        self.un_finished_tasks += 1
+
+    def _get(self):
+        return _heapq.heappop(self.queue)[2]
+
+    def _wait_ready(self, block, timeout):
+        """Wait, holding the mutex, until the earliest element is ready"""
+        deadline = _Deadline(timeout if block else 0)
+        while True:
+            now = _monotonic()
+            if self.queue and self.queue[0][0] <= now:
+                return
+            #sleep until the earliest ready time or the timeout, whichever first,
+            #a put of an earlier element notifies not_empty and ends the sleep
+            remaining = deadline.remaining()
+            if remaining == 0:
+                raise Empty
+            if self.queue:
+                ready_in = self.queue[0][0] - now
+                remaining = ready_in if remaining is None else min(remaining, ready_in)
+            self.n_waiting_getters += 1
+            try:
+                self.not_empty.wait(remaining)
+            finally:
+                self.n_waiting_getters -= 1
+
+    def get(self, block=True, timeout=None):
+        with self.mutex as lock:
+            self._wait_ready(block, timeout)
+            ele = self._get()
+            if self.n_waiting_putters:
+                self.not_full.notify()
+            #the next ready time may be for another waiting getter
+            if self.queue and self.n_waiting_getters:
+                self.not_empty.notify()
+            return ele
+
+    def get_many(self, max_eles, block=True, timeout=None):
+        """Wait like get() for one ready element, take up to `max_eles` ready ones"""
+        if max_eles < 1:
+            raise ValueError("max_eles must be >= 1, given(%d)" % max_eles)
+        with self.mutex as lock:
+            self._wait_ready(block, timeout)
+            now = _monotonic()
+            eles = []
+            while self.queue and len(eles) < max_eles and self.queue[0][0] <= now:
+                eles.append(self._get())
+            if self.n_waiting_putters:
+                self.not_full.notify(min(len(eles), self.n_waiting_putters))
+            if self.queue and self.n_waiting_getters:
+                self.not_empty.notify()
+            return eles
+
+def _stdlib_queue_class():
+    """The Queue class of the standard library, which this module shadows on python2"""
+    try:
+        import queue
+    except ImportError:
+        import imp
+        import os
+        stdlib_dir = os.path.dirname(_threading.__file__)
+        queue = imp.load_module('_stdlib_Queue', *imp.find_module('Queue', [stdlib_dir]))
+    return queue.Queue
+
+
+def benchmark(queue_class, n_producers, n_consumers, n_items=100000, maxsize=1000, batch=None):
+    """
+    Return items per second moved from `n_producers` to `n_consumers` threads,
+    one by one or with put_many/get_many of `batch` items
+    """
+    q = queue_class(maxsize)
+    per_producer = n_items // n_producers
+    n_items = per_producer * n_producers
+
+    def produce():
+        if batch is None:
+            for i in xrange(per_producer):
+                q.put(i)
+        else:
+            for i in xrange(0, per_producer, batch):
+                q.put_many(xrange(i, min(i + batch, per_producer)))
+
+    def consume(n):
+        if batch is None:
+            for i in xrange(n):
+                q.get()
+        else:
+            while n > 0:
+                n -= len(q.get_many(min(batch, n)))
+
+    shares = [n_items // n_consumers] * n_consumers
+    shares[0] += n_items - sum(shares)
+    threads = ([_threading.Thread(target=produce) for i in xrange(n_producers)] +
+               [_threading.Thread(target=consume, args=(n,)) for n in shares])
+    start = _monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return n_items / (_monotonic() - start)
+
+
 if __name__ == "__main__":
     import random
     import time
+    import sys
+
+    if sys.argv[1:] == ['bench']:
+        for n_producers, n_consumers in ((1, 1), (4, 4), (1, 8), (8, 1)):
+            for queue_class in (Queue, _stdlib_queue_class()):
+                print('{0}P/{1}C {2}.{3}: {4:.0f} items/s'.format(
+                    n_producers, n_consumers, queue_class.__module__, queue_class.__name__,
+                    benchmark(queue_class, n_producers, n_consumers)))
+        for batch in (1, 64, 1024):
+            print('4P/4C put_many/get_many of {0}: {1:.0f} items/s'.format(
+                batch, benchmark(Queue, 4, 4, maxsize=4096, batch=batch)))
+        sys.exit(0)
+
+    #used to deadlock: full() and empty() relocked the non-reentrant mutex
+    q = Queue(2)
+    assert q.empty() and not q.full()
+    q.put(1)
+    q.put(2)
+    assert q.full() and not q.empty() and q.qsize() == 2
+
+    #a list drained with pop(0) was quadratic
+    q = Queue()
+    for i in xrange(200000):
+        q.put(i)
+    assert [q.get() for i in xrange(200000)] == list(range(200000))
+
+    q = Queue(5)
+    assert q.put_many(range(3)) == 3
+    assert q.put_many(range(3, 10), block=False) == 2
+    assert q.put_many(range(5, 10), timeout=0.05) == 0
+    assert q.get_many(4) == [0, 1, 2, 3]
+    assert q.get_many(4) == [4]
+    try:
+        q.get_many(4, timeout=0.05)
+    except Empty:
+        pass
+    else:
+        assert False, "Empty expected"
+
+    lq = LifoQueue()
+    lq.put_many(range(5))
+    assert [lq.get() for i in range(5)] == [4, 3, 2, 1, 0]
+
+    pq = PriorityQueue(3)
+    pq.put_many([(2, 'b'), (3, 'c'), (1, 'a')])
+    assert pq.full()
+    assert pq.get_many(3) == [(1, 'a'), (2, 'b'), (3, 'c')]
+    pq.clear()
+
+    dq = DelayQueue()
+    start = _monotonic()
+    dq.put('late', delay=0.2)
+    dq.put('early', delay=0.1)
+    dq.put('now')
+    assert dq.get() == 'now'
+    try:
+        dq.get(timeout=0.02)
+    except Empty:
+        pass
+    else:
+        assert False, "Empty expected"
+    assert dq.get() == 'early' and _monotonic() - start >= 0.1
+    #a getter sleeping for 'late' is woken by a put of an earlier element
+    got = []
+    getter = _threading.Thread(target=lambda: got.append(dq.get()))
+    getter.start()
+    time.sleep(0.01)
+    dq.put('sooner')
+    getter.join(5)
+    assert got == ['sooner'], got
+    assert dq.get_many(5) == ['late'] and _monotonic() - start >= 0.2
+    assert dq.qsize() == 0
+
+    #blocked getters wake up, a blocked put_many completes as getters make room
+    got, n_put = [], []
+    getters = [_threading.Thread(target=lambda: got.extend(q.get_many(3))) for i in range(2)]
+    putter = _threading.Thread(target=lambda: n_put.append(q.put_many(range(12))))
+    for t in getters:
+        t.start()
+    time.sleep(0.05)
+    putter.start()
+    for t in getters:
+        t.join(5)
+    while len(got) < 12:
+        got.extend(q.get_many(12, timeout=5))
+    putter.join(5)
+    assert n_put == [12] and sorted(got) == list(range(12))
+    for i in range(12):
+        q.task_done()
+
+    #timeouts and delays are measured on the monotonic clock, stepping the
+    #wall clock an hour at each reading neither cuts them short nor stretches
+    #them. Forward, it also wakes the condition waits of python2 early, its
+    #threading reads its own _time; backward they would never wake
+    real_time, real_threading_time = time.time, getattr(_threading, '_time', None)
+    try:
+        for step in (3600, -3600):
+            readings = _itertools.count(1)
+            time.time = lambda: real_time() + step * next(readings)
+            if real_threading_time is not None:
+                _threading._time = time.time if step > 0 else real_threading_time
+            start = _monotonic()
+            try:
+                Queue().get(timeout=0.05)
+            except Empty:
+                pass
+            q = Queue(1)
+            q.put(1)
+            try:
+                q.put(2, timeout=0.05)
+            except Full:
+                pass
+            dq = DelayQueue()
+            dq.put('ready', delay=0.05)
+            assert dq.get(timeout=1) == 'ready'
+            assert 0.15 <= _monotonic() - start < 1
+    finally:
+        time.time = real_time
+        if real_threading_time is not None:
+            _threading._time = real_threading_time
 
     class Worker(_threading.Thread):
         def __init__(self, queue):
@@ -132,7 +480,7 @@ if __name__ == "__main__":
 
         def run(self):
             time.sleep(random.randint(1, 5) / 10.0)
-            print self.queue.get()
+            print(self.queue.get())
 
     q = Queue(10)
     for i in range(10):
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+#-*- encoding:utf-8 -*-
+"""
+RingBufferQueue passes fixed-size byte records between processes through a
+shared memory ring of `maxsize` slots, with the put/get/task_done/join of
+Queue.Queue.
+e.g.
+    q = RingBufferQueue(record_size=64, maxsize=1024)
+
+    def consume(q):
+        while True:
+            record = q.get()
+            ...
+            q.task_done()
+
+    Process(target=consume, args=(q,)).start()
+    q.put(b'a record of up to 64 bytes')
+    q.join()
+
+A record is any buffer of at most `record_size` bytes (bytes, bytearray,
+memoryview...). Nothing is pickled and nothing goes through a pipe: put()
+copies the caller's buffer straight into its slot through a memoryview of the
+map, get() copies the slot out as bytes, and get_into() into a buffer of the
+caller's, e.g. a preallocated bytearray reused for every record.
+
+Blocking is done with multiprocessing semaphores counting the free and the
+filled slots, putters and getters lock separately so a put and a get run in
+parallel. The ring is an anonymous shared map: create the queue before
+forking the processes using it, it can not be pickled to a spawned process.
+"""
+from __future__ import print_function
+
+import mmap
+import ctypes
+import struct
+import multiprocessing
+
+from timetools import monotonic, Deadline
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+
+class Full(Exception):
+    """Exception Full raised by RingBufferQueue.put/put_nowait"""
+
+class Empty(Exception):
+    """Exception Empty raised by RingBufferQueue.get/get_nowait"""
+
+
+#head and tail counters in their own cache lines, getters write the first, putters the second
+_COUNTER = struct.Struct('q')
+_HEAD_OFFSET = 0
+_TAIL_OFFSET = 64
+_HEADER_SIZE = 128
+#each slot starts with the length of its record
+_LENGTH = struct.Struct('I')
+
+
+def _byte_view(buf):
+    """A writable memoryview of bytes over `buf`, mmap has no memoryview on python2"""
+    view = memoryview((ctypes.c_char * len(buf)).from_buffer(buf))
+    return view.cast('B') if hasattr(view, 'cast') else view
+
+
+def _record_view(record):
+    """A memoryview of the bytes of `record`, TypeError if it is no buffer, e.g. a str on python3"""
+    view = memoryview(record)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B') if hasattr(view, 'cast') else memoryview(view.tobytes())
+    return view
+
+
+def _buffer_view(buf):
+    """A writable memoryview of the bytes of `buf`, TypeError if it is no such buffer"""
+    view = memoryview(buf)
+    if view.format != 'B' or view.ndim != 1:
+        if not hasattr(view, 'cast'):
+            raise TypeError("buf must be a buffer of bytes")
+        view = view.cast('B')
+    if view.readonly:
+        raise TypeError("buf must be writable")
+    return view
+
+
+class RingBufferQueue(object):
+    def __init__(self, record_size, maxsize):
+        if record_size < 1 or maxsize < 1:
+            raise ValueError("record_size and maxsize must be >= 1, given(%d, %d)"
+                             % (record_size, maxsize))
+        self.record_size = record_size
+        self.maxsize = maxsize
+        #8 bytes aligned slots
+        self.slot_size = (_LENGTH.size + record_size + 7) & ~7
+        self.map = mmap.mmap(-1, _HEADER_SIZE + self.slot_size * maxsize)
+        self.buf = _byte_view(self.map)
+
+        self.put_lock = multiprocessing.Lock()
+        self.get_lock = multiprocessing.Lock()
+        self.free_slots = multiprocessing.Semaphore(maxsize)
+        self.filled_slots = multiprocessing.Semaphore(0)
+
+        self.unfinished_tasks = multiprocessing.Semaphore(0)
+        self.all_tasks_done = multiprocessing.Condition(multiprocessing.Lock())
+
+    def _slot(self, counter):
+        return _HEADER_SIZE + (counter % self.maxsize) * self.slot_size
+
+    #qsize/full/empty are snapshots, like Queue.Queue
+    def qsize(self):
+        tail, = _COUNTER.unpack_from(self.buf, _TAIL_OFFSET)
+        head, = _COUNTER.unpack_from(self.buf, _HEAD_OFFSET)
+        return max(tail - head, 0)
+
+    def full(self):
+        return self.qsize() >= self.maxsize
+
+    def empty(self):
+        return self.qsize() <= 0
+
+    def put(self, record, block=True, timeout=None):
+        if not self._put_many((record,), block, timeout):
+            raise Full
+
+    def put_nowait(self, record):
+        self.put(record, False)
+
+    def put_many(self, records, block=True, timeout=None):
+        """
+        Put the records under one lock acquisition as long as slots are free,
+        like Queue.put_many: wait for free slots for the rest unless not
+        `block` or until `timeout`, return the number of records put.
+        """
+        records = list(records)
+        n_put = 0
+        deadline = Deadline(timeout)
+        while n_put < len(records):
+            n = self._put_many(records[n_put:], block, deadline.remaining())
+            if not n:
+                break
+            n_put += n
+        return n_put
+
+    def _put_many(self, records, block, timeout):
+        """Wait for one free slot, fill it and those free right now, return their number"""
+        #checked before taking slots, a record failing to copy would leak them
+        records = [_record_view(record) for record in records]
+        for record in records:
+            if len(record) > self.record_size:
+                raise ValueError("record of %d bytes, record_size is %d"
+                                 % (len(record), self.record_size))
+        if timeout is not None and timeout < 0:
+            raise ValueError("timeout must be >0, given(%d)" % timeout)
+        if not self.free_slots.acquire(block, timeout):
+            return 0
+        n_slots = 1
+        while n_slots < len(records) and self.free_slots.acquire(False):
+            n_slots += 1
+
+        buf = self.buf
+        try:
+            with self.put_lock:
+                tail, = _COUNTER.unpack_from(buf, _TAIL_OFFSET)
+                for i in xrange(n_slots):
+                    record = records[i]
+                    offset = self._slot(tail + i)
+                    _LENGTH.pack_into(buf, offset, len(record))
+                    offset += _LENGTH.size
+                    buf[offset:offset + len(record)] = record
+                _COUNTER.pack_into(buf, _TAIL_OFFSET, tail + n_slots)
+        except BaseException:
+            #the tail did not move, the slots are free again
+            for i in xrange(n_slots):
+                self.free_slots.release()
+            raise
+        #counted before they can be got, task_done() of one never runs first
+        for i in xrange(n_slots):
+            self.unfinished_tasks.release()
+        for i in xrange(n_slots):
+            self.filled_slots.release()
+        return n_slots
+
+    def _get_into(self, buf, block, timeout):
+        #checked before taking a slot, a record failing to copy would leak it
+        if buf is not None:
+            buf = _buffer_view(buf)
+            if len(buf) < self.record_size:
+                raise ValueError("buf of %d bytes, record_size is %d"
+                                 % (len(buf), self.record_size))
+        if timeout is not None and timeout < 0:
+            raise ValueError("timeout must be > 0, given(%d)" % timeout)
+        if not self.filled_slots.acquire(block, timeout):
+            raise Empty
+
+        try:
+            with self.get_lock:
+                head, = _COUNTER.unpack_from(self.buf, _HEAD_OFFSET)
+                offset = self._slot(head)
+                length, = _LENGTH.unpack_from(self.buf, offset)
+                offset += _LENGTH.size
+                slot = self.buf[offset:offset + length]
+                if buf is None:
+                    record = slot.tobytes()
+                else:
+                    buf[:length] = slot
+                    record = length
+                _COUNTER.pack_into(self.buf, _HEAD_OFFSET, head + 1)
+        except BaseException:
+            #the head did not move, the record can be got again
+            self.filled_slots.release()
+            raise
+        self.free_slots.release()
+        return record
+
+    def get(self, block=True, timeout=None):
+        """Remove and return a record as bytes"""
+        return self._get_into(None, block, timeout)
+
+    def get_many(self, max_records, block=True, timeout=None):
+        """
+        Wait like get() for one record, then remove up to `max_records` under
+        the same lock acquisition, return them as a list of bytes.
+        """
+        if max_records < 1:
+            raise ValueError("max_records must be >= 1, given(%d)" % max_records)
+        if timeout is not None and timeout < 0:
+            raise ValueError("timeout must be > 0, given(%d)" % timeout)
+        if not self.filled_slots.acquire(block, timeout):
+            raise Empty
+        n_slots = 1
+        while n_slots < max_records and self.filled_slots.acquire(False):
+            n_slots += 1
+
+        buf = self.buf
+        records = []
+        with self.get_lock:
+            head, = _COUNTER.unpack_from(buf, _HEAD_OFFSET)
+            for i in xrange(n_slots):
+                offset = self._slot(head + i)
+                length, = _LENGTH.unpack_from(buf, offset)
+                offset += _LENGTH.size
+                records.append(buf[offset:offset + length].tobytes())
+            _COUNTER.pack_into(buf, _HEAD_OFFSET, head + n_slots)
+        for i in xrange(n_slots):
+            self.free_slots.release()
+        return records
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get_into(self, buf, block=True, timeout=None):
+        """
+        Remove a record and copy it to the start of the writable buffer `buf`
+        of at least `record_size` bytes, return its length.
+        """
+        return self._get_into(buf, block, timeout)
+
+    def task_done(self):
+        with self.all_tasks_done:
+            if not self.unfinished_tasks.acquire(False):
+                raise ValueError("task_done() called too many times")
+            if self.unfinished_tasks.get_value() == 0:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks.get_value() > 0:
+                self.all_tasks_done.wait()
+
+
+def _produce(q, record, n_records, batch):
+    if batch is None:
+        for i in xrange(n_records):
+            q.put(record)
+    else:
+        for i in xrange(0, n_records, batch):
+            q.put_many([record] * min(batch, n_records - i))
+
+
+def benchmark(q, record_size, n_records=100000, batch=None):
+    """
+    Return records per second moved through `q` from a producer process to
+    this one, one by one or with put_many/get_many of `batch` records
+    """
+    record = b'x' * record_size
+    producer = multiprocessing.Process(target=_produce, args=(q, record, n_records, batch))
+    start = monotonic()
+    producer.start()
+    if batch is None:
+        for i in xrange(n_records):
+            q.get()
+    else:
+        n = n_records
+        while n > 0:
+            n -= len(q.get_many(min(batch, n)))
+    elapsed = monotonic() - start
+    producer.join()
+    return n_records / elapsed
+
+
+def _echo(requests, replies, n_records):
+    buf = bytearray(requests.record_size)
+    for i in xrange(n_records):
+        length = requests.get_into(buf)
+        replies.put(memoryview(buf)[:length])
+        requests.task_done()
+
+
+if __name__ == "__main__":
+    import sys
+    import threading
+
+    if sys.argv[1:] == ['bench']:
+        for record_size in (64, 4096):
+            for name, q in (('RingBufferQueue', RingBufferQueue(record_size, 1024)),
+                            ('multiprocessing.Queue', multiprocessing.Queue(1024))):
+                print('{0} {1}B records: {2:.0f} records/s'.format(
+                    name, record_size, benchmark(q, record_size)))
+            print('RingBufferQueue {0}B records, batches of 64: {1:.0f} records/s'.format(
+                record_size, benchmark(RingBufferQueue(record_size, 1024), record_size, batch=64)))
+        sys.exit(0)
+
+    q = RingBufferQueue(8, 3)
+    assert q.empty() and not q.full()
+    q.put(b'a')
+    q.put(bytearray(b'bc'))
+    q.put(memoryview(b'12345678'))
+    assert q.full() and q.qsize() == 3
+    try:
+        q.put(b'd', timeout=0.05)
+    except Full:
+        pass
+    else:
+        assert False, "Full expected"
+    try:
+        q.put(b'123456789')
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError expected"
+    assert q.get() == b'a'
+    #a buffer too short or read-only is refused before it takes a slot
+    for buf in (bytearray(4), b'12345678'):
+        try:
+            q.get_into(buf)
+        except (ValueError, TypeError):
+            pass
+        else:
+            assert False, "ValueError or TypeError expected"
+    assert q.qsize() == 2
+    buf = bytearray(8)
+    assert q.get_into(buf) == 2 and buf[:2] == b'bc'
+    #the ring wraps around
+    q.put_nowait(b'')
+    assert q.get() == b'12345678' and q.get() == b''
+    try:
+        q.get_nowait()
+    except Empty:
+        pass
+    else:
+        assert False, "Empty expected"
+    for i in range(4):
+        q.task_done()
+    try:
+        q.task_done()
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError expected"
+
+    assert q.put_many([b'1', b'22', b'333', b'4444'], block=False) == 3
+    assert q.get_many(2) == [b'1', b'22']
+    assert q.put_many([b'5', b'6'], timeout=0.05) == 2
+    assert q.get_many(5) == [b'333', b'5', b'6']
+    for i in range(5):
+        q.task_done()
+    #a text record is refused before it takes a slot
+    try:
+        q.put(u'abc')
+    except TypeError:
+        pass
+    else:
+        assert False, "TypeError expected"
+    if hasattr(memoryview, 'cast'):
+        import array
+        q.put(array.array('H', [1, 2]))
+        assert q.get() == array.array('H', [1, 2]).tobytes()
+        q.task_done()
+    assert q.put_many([b'1', b'2', b'3', b'4'], block=False) == 3
+    assert q.get_many(3) == [b'1', b'2', b'3']
+    for i in range(3):
+        q.task_done()
+
+    #records go through a child process and back, join() waits for its task_done()
+    requests, replies = RingBufferQueue(16, 4), RingBufferQueue(16, 4)
+    echo = multiprocessing.Process(target=_echo, args=(requests, replies, 1000))
+    echo.start()
+    records = [str(i).encode() * (i % 4 + 1) for i in range(1000)]
+    putter = threading.Thread(target=lambda: [requests.put(r) for r in records])
+    putter.start()
+    assert [replies.get(timeout=5) for i in range(1000)] == records
+    putter.join()
+    requests.join()
+    echo.join(5)
+    assert echo.exitcode == 0
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#-*- encoding:utf-8 -*-
+"""
+guard(lock) is what to hold a lock with:
+    with guard(self.mutex):
+        ...
+
+It returns the lock itself, so the with statement runs the native
+__enter__/__exit__ of the lock: nothing is added on top of them, an exception
+raised in the block propagates, only the owner releases, and a reentrant lock
+is reentered as usual.
+
+Once enable_profiling() is called, guard() returns a guard timing how long
+each acquisition waited, counted by call site, i.e. the file and line of the
+with statement. contention_report() lists the call sites, the most waited
+first, to find which lock of which code path threads queue on:
+    enable_profiling()
+    ...
+    for site in contention_report():
+        print(site['site'], site['n_contended'], site['wait_time'])
+
+Profiling costs a frame lookup per acquisition, and a clock read when the lock
+is contended, turn it off with disable_profiling().
+"""
+from __future__ import print_function
+
+import sys
+import threading
+
+from timetools import monotonic
+
+
+__all__ = ['guard', 'enable_profiling', 'disable_profiling', 'contention_report']
+
+
+class _Profiler(object):
+    def __init__(self):
+        self.mutex = threading.Lock()
+        #(filename, lineno) -> [n_acquired, n_contended, wait_time, max_wait]
+        self.sites = {}
+
+    def record(self, site, wait_time):
+        with self.mutex:
+            stats = self.sites.get(site)
+            if stats is None:
+                stats = self.sites[site] = [0, 0, 0.0, 0.0]
+            stats[0] += 1
+            if wait_time is not None:
+                stats[1] += 1
+                stats[2] += wait_time
+                stats[3] = max(stats[3], wait_time)
+
+
+_profiler = None
+
+
+class _ProfiledGuard(object):
+    __slots__ = ('lock', 'site')
+
+    def __init__(self, lock, site):
+        self.lock = lock
+        self.site = site
+
+    def __enter__(self):
+        wait_time = None
+        if not self.lock.acquire(False):
+            start = monotonic()
+            self.lock.acquire()
+            wait_time = monotonic() - start
+        profiler = _profiler
+        if profiler is not None:
+            profiler.record(self.site, wait_time)
+        return self.lock
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+        return False
+
+
+def guard(lock):
+    """The context manager holding `lock`, the lock itself unless profiling"""
+    if _profiler is None:
+        return lock
+    frame = sys._getframe(1)
+    return _ProfiledGuard(lock, (frame.f_code.co_filename, frame.f_lineno))
+
+
+def enable_profiling():
+    """Count the acquisitions and waits of guard() by call site, from now on"""
+    global _profiler
+    if _profiler is None:
+        _profiler = _Profiler()
+
+
+def disable_profiling():
+    global _profiler
+    _profiler = None
+
+
+def contention_report():
+    """The call sites of guard() seen while profiling, the most waited first"""
+    profiler = _profiler
+    if profiler is None:
+        return []
+    with profiler.mutex:
+        sites = list(profiler.sites.items())
+    report = [{'site': '{0}:{1}'.format(filename, lineno),
+               'n_acquired': n_acquired,
+               'n_contended': n_contended,
+               'wait_time': wait_time,
+               'max_wait': max_wait}
+              for (filename, lineno), (n_acquired, n_contended, wait_time, max_wait) in sites]
+    report.sort(key=lambda site: site['wait_time'], reverse=True)
+    return report
+
+
+if __name__ == '__main__':
+    import time
+
+    lock = threading.Lock()
+    assert guard(lock) is lock
+    try:
+        with guard(lock):
+            assert lock.locked()
+            raise KeyError('propagated')
+    except KeyError:
+        pass
+    else:
+        assert False, "KeyError expected"
+    assert not lock.locked()
+
+    rlock = threading.RLock()
+    with guard(rlock):
+        with guard(rlock):
+            pass
+        #still owned after the inner block, released by the outer one only
+        acquired = []
+        def probe():
+            acquired.append(rlock.acquire(False))
+            if acquired[0]:
+                rlock.release()
+        prober = threading.Thread(target=probe)
+        prober.start()
+        prober.join()
+        assert acquired == [False]
+    assert rlock.acquire(False)
+    rlock.release()
+
+    enable_profiling()
+    def hold():
+        with guard(lock):
+            time.sleep(0.05)
+    def wait():
+        with guard(lock):
+            pass
+    holder = threading.Thread(target=hold)
+    holder.start()
+    time.sleep(0.01)
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    holder.join()
+    waiter.join()
+    for i in range(3):
+        with guard(rlock):
+            with guard(rlock):
+                pass
+    report = contention_report()
+    assert len(report) == 4, report
+    assert report[0]['site'].endswith(':{0}'.format(wait.__code__.co_firstlineno + 1))
+    assert report[0]['n_contended'] == 1 and 0.02 < report[0]['wait_time'] == report[0]['max_wait']
+    assert sorted(site['n_acquired'] for site in report) == [1, 1, 3, 3]
+    try:
+        with guard(lock):
+            raise KeyError('propagated')
+    except KeyError:
+        pass
+    assert not lock.locked()
+    disable_profiling()
+    assert guard(lock) is lock and contention_report() == []
@@ -9,14 +9,93 @@ All Duration and Time class has the precision of milliseconds.
 Except Time.clock has the real precision of time.clock (gettimeofday in unix-like system).
 
 Please use time.strptime, time.strftime and so on to format the Time.
+
+monotonic() is a clock that NTP and the date command can not step, and
+Deadline measures timeouts on it. Blocking calls with a timeout use them, so
+a wall clock jump neither cuts their wait short nor stretches it by the jump:
+    deadline = Deadline(timeout)
+    with condition:
+        while not ready():
+            if not deadline.wait(condition):
+                raise Timeout
 """
 from __future__ import division
+from __future__ import print_function
 from functools import total_ordering
 
 import time
 
 
-__all__ = ['Duration', 'Time']
+__all__ = ['Duration', 'Time', 'monotonic', 'Deadline']
+
+
+def _clock_gettime_monotonic():
+    """monotonic() of python2 on linux, None elsewhere"""
+    import ctypes
+    import ctypes.util
+
+    try:
+        #PyDLL keeps the GIL over the call, cheaper
+        librt = ctypes.PyDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    CLOCK_MONOTONIC = 1
+    #struct timespec {tv_sec, tv_nsec}
+    timespec = ctypes.c_long * 2
+    if clock_gettime(CLOCK_MONOTONIC, timespec()) != 0:
+        return None
+
+    def monotonic():
+        #one per call: the GIL is released between the call and the reads of
+        #the fields, a shared one could mix the seconds of another thread in
+        ts = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ts)
+        return ts[0] + ts[1] * 1e-9
+    return monotonic
+
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    #the wall clock is the last resort, it is what python2 uses everywhere
+    monotonic = _clock_gettime_monotonic() or time.time
+
+
+class Deadline(object):
+    """
+    The point `timeout` seconds from now on the monotonic clock,
+    a timeout of None never comes.
+    """
+    __slots__ = ('end',)
+
+    def __init__(self, timeout=None):
+        if timeout is not None and timeout < 0:
+            raise ValueError("timeout must be >= 0, given({0})".format(timeout))
+        self.end = None if timeout is None else monotonic() + timeout
+
+    def remaining(self):
+        """Seconds left, 0 once expired, None without a timeout"""
+        if self.end is None:
+            return None
+        return max(self.end - monotonic(), 0.0)
+
+    def expired(self):
+        return self.end is not None and monotonic() >= self.end
+
+    def wait(self, condition):
+        """
+        condition.wait() until notified or the deadline, the lock of the
+        condition held. Return False at once if expired, as a timeout.
+        """
+        if self.end is None:
+            condition.wait()
+            return True
+        remaining = self.end - monotonic()
+        if remaining <= 0:
+            return False
+        condition.wait(remaining)
+        return True
 
 
 class TIME(object):
@@ -65,7 +144,6 @@ class Tzname(object):
 
 class StructTime(object):
     def __get__(self, instance, owner):
-        print instance.seconds
         return time.localtime(instance.seconds)
 
 
@@ -210,29 +288,84 @@ class Time(object):
 
 
 if __name__ == '__main__':
+    import itertools
+    import threading
+
+    assert monotonic is not time.time
+    start = monotonic()
+    time.sleep(0.01)
+    assert 0.009 <= monotonic() - start < 1
+
+    assert Deadline().remaining() is None and not Deadline().expired()
+    assert Deadline(0).expired() and Deadline(0).remaining() == 0
+    condition = threading.Condition()
+    with condition:
+        deadline = Deadline(0.05)
+        while deadline.wait(condition):
+            pass
+    assert deadline.expired() and monotonic() - start >= 0.05
+
+    #never backwards, across threads either
+    backwards = []
+    def check():
+        last = monotonic()
+        for i in range(200000):
+            now = monotonic()
+            if now < last:
+                backwards.append(last - now)
+            last = now
+    checkers = [threading.Thread(target=check) for i in range(8)]
+    for checker in checkers:
+        checker.start()
+    for checker in checkers:
+        checker.join()
+    assert not backwards, max(backwards)
+
+    #the wall clock steps an hour at each reading and changes nothing. Forward,
+    #it also wakes the condition waits of python2 early, its threading reads
+    #its own _time; backward they would never wake, only time.time steps then
+    real_time, real_threading_time = time.time, getattr(threading, '_time', None)
+    try:
+        for step in (3600, -3600):
+            readings = itertools.count(1)
+            time.time = lambda: real_time() + step * next(readings)
+            if real_threading_time is not None:
+                threading._time = time.time if step > 0 else real_threading_time
+            start = monotonic()
+            deadline = Deadline(0.05)
+            assert not deadline.expired() and 0 < deadline.remaining() <= 0.05
+            with condition:
+                while deadline.wait(condition):
+                    pass
+            assert 0.05 <= monotonic() - start < 1
+    finally:
+        time.time = real_time
+        if real_threading_time is not None:
+            threading._time = real_threading_time
+
     d = Duration(days=1, mseconds=0.1)
-    print d.days
-    print d.hours
-    print (d + d).hours
-    print (d - d).minutes
-    print d
+    print(d.days)
+    print(d.hours)
+    print((d + d).hours)
+    print((d - d).minutes)
+    print(d)
     d += d
     d -=d
-    print d
+    print(d)
 
     t = Time.now()
-    print t.mseconds
-    print t.seconds
-    print t.struct_time
-    print t-t
-    print t-d
-    print t == t
+    print(t.mseconds)
+    print(t.seconds)
+    print(t.struct_time)
+    print(t-t)
+    print(t-d)
+    print(t == t)
 
     tt = t + Duration(mseconds=1)
     try:
         t - tt
     except ValueError as e:
-        print e.message
+        print(e)
 
     time.sleep(Duration(seconds=1))
     Duration(mseconds=1).sleep()